@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+
+#  Licensed under the Apache License, Version 2.0 (the "License"); you may
+#  not use this file except in compliance with the License. You may obtain
+#  a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#  License for the specific language governing permissions and limitations
+#  under the License.
+
+"""Local usage counters by event name and source type, rolled up per hour.
+
+Counts are aggregated in memory and merged every `flush_interval` seconds
+into one directory per UTC day:
+
+    <directory>/20240220/keys.txt    one 'name|source' key per line
+    <directory>/20240220/counts.u32  uint32 array, 24 hourly counts per key
+
+so a day is read with two file reads and no parsing beyond the key list.
+Workers merge under an exclusive flock of the day directory.
+
+    python analytics.py <directory> top [--days 30] [-n 10] [--prefix text:]
+    python analytics.py <directory> series <key> [--days 30] [--hourly]
+"""
+
+import atexit
+import datetime
+import fcntl
+import logging
+import os
+import sys
+import threading
+import time
+from argparse import ArgumentParser
+from array import array
+from collections import Counter
+
+
+KEYS_NAME = 'keys.txt'
+COUNTS_NAME = 'counts.u32'
+LOCK_NAME = 'lock'
+HOURS = 24
+
+logger = logging.getLogger(__name__)
+
+
+def _day_path(directory, day):
+    return os.path.join(directory, day.strftime('%Y%m%d'))
+
+
+def load_day(directory, day):
+    """Return (keys, counts) for day, counts being 24 slots per key."""
+    path = _day_path(directory, day)
+    try:
+        with open(os.path.join(path, KEYS_NAME), encoding='utf-8') as f:
+            keys = f.read().splitlines()
+    except FileNotFoundError:
+        return [], array('I')
+    counts = array('I')
+    with open(os.path.join(path, COUNTS_NAME), 'rb') as f:
+        counts.frombytes(f.read())
+    # keys are appended before counts are replaced, so counts may be short
+    counts.extend([0] * (HOURS * len(keys) - len(counts)))
+    return keys, counts
+
+
+def _merge_day(directory, day, rows):
+    path = _day_path(directory, day)
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, LOCK_NAME), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        keys, counts = load_day(directory, day)
+        key_ids = {key: i for i, key in enumerate(keys)}
+        new_keys = [key for key in rows if key not in key_ids]
+        if new_keys:
+            with open(os.path.join(path, KEYS_NAME), 'a', encoding='utf-8') as f:
+                f.write(''.join(key + '\n' for key in new_keys))
+            for key in new_keys:
+                key_ids[key] = len(key_ids)
+            counts.extend([0] * (HOURS * len(new_keys)))
+        for key, hours in rows.items():
+            base = HOURS * key_ids[key]
+            for hour, count in hours.items():
+                counts[base + hour] += count
+        tmp_path = os.path.join(path, COUNTS_NAME + '.tmp')
+        with open(tmp_path, 'wb') as f:
+            counts.tofile(f)
+        os.replace(tmp_path, os.path.join(path, COUNTS_NAME))
+
+
+class AnalyticsRecorder(object):
+
+    def __init__(self, directory, flush_interval=60):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._counts = Counter()
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def record(self, name, source_type):
+        hour = int(time.time() // 3600)
+        with self._lock:
+            if self._pid != os.getpid():
+                self._counts = Counter()
+                self._pid = os.getpid()
+                threading.Thread(target=self._run, name='analytics-flusher', daemon=True).start()
+                atexit.register(self.flush)
+            self._counts[(hour, name + '|' + (source_type or 'none'))] += 1
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except OSError:
+                logger.exception('Failed to flush analytics')
+
+    def flush(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                return
+            counts, self._counts = self._counts, Counter()
+
+        days = {}
+        for (hour, key), count in counts.items():
+            moment = datetime.datetime.fromtimestamp(hour * 3600, datetime.timezone.utc)
+            days.setdefault(moment.date(), {}).setdefault(key, {})[moment.hour] = count
+        for day, rows in days.items():
+            _merge_day(self.directory, day, rows)
+
+
+def _days(end, days):
+    return [end - datetime.timedelta(days=i) for i in range(days - 1, -1, -1)]
+
+
+def top(directory, days=30, n=10, prefix='', end=None):
+    """Return the n most common (key, count) over the last days."""
+    total = Counter()
+    for day in _days(end or datetime.datetime.now(datetime.timezone.utc).date(), days):
+        keys, counts = load_day(directory, day)
+        for i, key in enumerate(keys):
+            if key.startswith(prefix):
+                total[key] += sum(counts[HOURS * i:HOURS * (i + 1)])
+    return [(key, count) for key, count in total.most_common(n) if count]
+
+
+def series(directory, key, days=30, hourly=False, end=None):
+    """Return [(label, count)] for key per day, or per hour if hourly."""
+    result = []
+    for day in _days(end or datetime.datetime.now(datetime.timezone.utc).date(), days):
+        keys, counts = load_day(directory, day)
+        hours = [0] * HOURS
+        if key in keys:
+            i = keys.index(key)
+            hours = counts[HOURS * i:HOURS * (i + 1)].tolist()
+        label = day.strftime('%Y%m%d')
+        if hourly:
+            result.extend(('{}{:02d}'.format(label, hour), count) for hour, count in enumerate(hours))
+        else:
+            result.append((label, sum(hours)))
+    return result
+
+
+if __name__ == '__main__':
+    arg_parser = ArgumentParser(
+        usage='Usage: python ' + __file__ + ' <directory> (top | series <key>) [--days <n>] [options]'
+    )
+    arg_parser.add_argument('directory', help='ANALYTICS_DIR of the app')
+    arg_parser.add_argument('query', choices=['top', 'series'])
+    arg_parser.add_argument('key', nargs='?', default=None, help='key for series, e.g. text:profile|user')
+    arg_parser.add_argument('--days', type=int, default=30)
+    arg_parser.add_argument('-n', type=int, default=10, help='number of keys for top')
+    arg_parser.add_argument('--prefix', default='', help='only keys starting with this for top')
+    arg_parser.add_argument('--hourly', action='store_true', help='hourly series')
+    options = arg_parser.parse_args()
+
+    if options.query == 'top':
+        rows = top(options.directory, options.days, options.n, options.prefix)
+    elif options.key is None:
+        arg_parser.print_usage()
+        sys.exit(1)
+    else:
+        rows = series(options.directory, options.key, options.days, options.hourly)
+    for label, count in rows:
+        print('{}\t{}'.format(label, count))
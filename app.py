@@ -79,6 +79,11 @@ from linebot.v3.messaging import (
     CarouselColumn,
     ImageCarouselTemplate,
     ImageCarouselColumn,
+    ImagemapMessage,
+    ImagemapBaseSize,
+    ImagemapArea,
+    URIImagemapAction,
+    MessageImagemapAction,
     FlexBubble,
     FlexImage,
     FlexBox,
@@ -94,6 +99,7 @@ from linebot.v3.messaging import (
     CameraAction,
     CameraRollAction,
     LocationAction,
+    UserProfileResponse,
     ErrorResponse
 )
 
@@ -102,6 +108,18 @@ from linebot.v3.insight import (
     Insight
 )
 
+import analytics
+from audience import narrowcast
+from beacon import BeaconAggregator
+from dedupe import DeduplicatingParser
+from images import ImageVariants, PREVIEW_NAME
+from journal import Journal
+from kvstore import open_backend
+from membership import MembershipIndex, UNAVAILABLE as MEMBERS_UNAVAILABLE
+from postback import PostbackRouter
+from richmenu import RichMenuAssigner
+from store_index import load_store_index
+
 
 app = Flask(__name__)
 app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_host=1, x_proto=1)
@@ -118,12 +136,69 @@ if channel_secret is None or channel_access_token is None:
 
 handler = WebhookHandler(channel_secret)
 
+# state shared by all workers and nodes: memory://, sqlite:///path or
+# redis://host:port/db, see kvstore.py; gunicorn.conf.py defaults to a
+# SQLite file when it runs several workers
+kv_store = open_backend(os.getenv('KV_URL', 'memory://'))
+# redelivered webhook events are dropped before they reach the handlers
+event_deduplicator = DeduplicatingParser(handler.parser, kv_store)
+handler.parser = event_deduplicator
+PROFILE_CACHE_SECONDS = 60 * 60
+
 static_tmp_path = os.path.join(os.path.dirname(__file__), 'static', 'tmp')
+static_logo_path = os.path.join(os.path.dirname(__file__), 'static', 'logo.png')
+
+# preview and imagemap sizes of images, generated on a process pool
+image_variants = ImageVariants(os.path.join(static_tmp_path, 'variants'),
+                               max_workers=int(os.getenv('IMAGE_POOL_WORKERS', '2')))
+IMAGEMAP_BASE_WIDTH = 1040
+IMAGEMAP_WAIT_SECONDS = 5
+CONTENT_PREVIEW_WAIT_SECONDS = 2
 
 configuration = Configuration(
     access_token=channel_access_token
 )
 
+# optional append-only journal of verified webhook bodies, see replay.py
+journal_dir = os.getenv('WEBHOOK_JOURNAL_DIR', None)
+webhook_journal = Journal(journal_dir) if journal_dir else None
+
+# nearest-store replies for location messages; a .csv is indexed at startup,
+# anything else is treated as a prebuilt index file and memory-mapped
+store_index_path = os.getenv('STORE_INDEX_PATH', None)
+store_index = load_store_index(store_index_path) if store_index_path else None
+NEAREST_STORE_COUNT = 3
+
+postback_router = PostbackRouter()
+
+# local usage counters, see analytics.py
+analytics_dir = os.getenv('ANALYTICS_DIR', None)
+analytics_recorder = analytics.AnalyticsRecorder(analytics_dir) if analytics_dir else None
+TEXT_COMMANDS = frozenset([
+    'profile', 'emojis', 'quota', 'quota_consumption', 'push', 'multicast', 'broadcast', 'member_count',
+    'rich_menu_progress', 'stats', 'bye', 'image', 'confirm', 'buttons', 'carousel', 'image_carousel',
+    'imagemap', 'flex', 'flex_update_1', 'quick_reply', 'link_token', 'insight_message_delivery',
+    'insight_followers', 'insight_demographic', 'with http info', 'with http info error',
+])
+TEXT_COMMAND_PREFIXES = ('broadcast ', 'narrowcast ')
+
+# member IDs of joined groups and rooms, kept current from member events and
+# shared by all workers through kv_store
+membership_index = MembershipIndex(configuration, store=kv_store)
+
+# per-user rich menu links, sent in bulk off the webhook path
+rich_menu_assigner = RichMenuAssigner(configuration, store=kv_store)
+default_rich_menu_id = os.getenv('RICH_MENU_DEFAULT_ID', None)
+
+# reply to at most one beacon event per user, hwid and type in each window,
+# counted across all workers through kv_store
+beacon_aggregator = BeaconAggregator(
+    window=int(os.getenv('BEACON_WINDOW_SECONDS', '60')),
+    history=int(os.getenv('BEACON_HISTORY_WINDOWS', '60')),
+    max_keys=int(os.getenv('BEACON_MAX_KEYS', '100000')),
+    store=kv_store
+)
+
 
 # function for create tmp dir for download content
 def make_static_tmp_dir():
@@ -136,6 +211,73 @@ def make_static_tmp_dir():
             raise
 
 
+# one ApiClient, and so one connection pool, per process; created lazily
+# because connection pools must not be inherited across fork
+_shared_api_client = None
+_shared_api_client_pid = None
+
+
+def shared_api_client():
+    global _shared_api_client, _shared_api_client_pid
+    if _shared_api_client_pid != os.getpid():
+        _shared_api_client = ApiClient(configuration)
+        _shared_api_client_pid = os.getpid()
+    return _shared_api_client
+
+
+# runs at import, i.e. once in the gunicorn master with preload_app, so that
+# everything loaded here is shared copy-on-write by the forked workers
+def warm_up():
+    make_static_tmp_dir()
+    image_variants.warm(static_logo_path)
+
+
+# runs in each gunicorn worker after fork (see gunicorn.conf.py)
+def init_worker():
+    shared_api_client()
+
+
+def record_event(event, name):
+    if analytics_recorder is not None:
+        analytics_recorder.record(name, getattr(event.source, 'type', None))
+
+
+def cached_profile(line_bot_api, user_id):
+    # the cache is optional: if the backend fails, ask the API instead
+    key = 'profile:' + user_id
+    try:
+        cached = kv_store.get(key)
+    except Exception:
+        app.logger.exception("Failed to read cached profile")
+        cached = None
+    if cached is not None:
+        return UserProfileResponse.from_json(cached.decode('utf-8'))
+    profile = line_bot_api.get_profile(user_id=user_id)
+    try:
+        kv_store.set(key, profile.to_json().encode('utf-8'), ttl=PROFILE_CACHE_SECONDS)
+    except Exception:
+        app.logger.exception("Failed to cache profile")
+    return profile
+
+
+# LINE only accepts https URLs, while url_root is http behind a proxy that
+# does not send X-Forwarded-Proto
+def public_url(path):
+    url = request.url_root + path
+    if url.startswith('http://'):
+        url = 'https://' + url[len('http://'):]
+    return url
+
+
+def text_command_name(text):
+    if text in TEXT_COMMANDS:
+        return text
+    for prefix in TEXT_COMMAND_PREFIXES:
+        if text.startswith(prefix):
+            return prefix + '*'
+    return 'echo'
+
+
 @app.route("/callback", methods=['POST'])
 def callback():
     # get X-Line-Signature header value
@@ -145,6 +287,14 @@ def callback():
     body = request.get_data(as_text=True)
     app.logger.info("Request body: " + body)
 
+    # journal the body before handling it so that it survives the worker
+    # being killed mid-request (fsyncs against a host crash are batched)
+    journal_offset = None
+    if webhook_journal is not None:
+        if not handler.parser.signature_validator.validate(body, signature):
+            abort(400)
+        journal_offset = webhook_journal.append(body.encode('utf-8'))
+
     # handle webhook body
     try:
         handler.handle(body, signature)
@@ -152,18 +302,157 @@ def callback():
         app.logger.warn("Got exception from LINE Messaging API: %s\n" % e.body)
     except InvalidSignatureError:
         abort(400)
+    except Exception:
+        # set aside for replay.py without holding back the checkpoint
+        if journal_offset is not None:
+            webhook_journal.fail(journal_offset)
+        raise
+    event_deduplicator.handled()
+
+    if journal_offset is not None:
+        webhook_journal.commit(journal_offset)
 
     return 'OK'
 
 
+# parsed once at import so workers share it copy-on-write
+FLEX_UPDATE_1_JSON = """
+{
+"type": "bubble",
+"body": {
+    "type": "box",
+    "layout": "vertical",
+    "contents": [
+    {
+        "type": "image",
+        "url": "https://scdn.line-apps.com/n/channel_devcenter/img/flexsnapshot/clip/clip3.jpg",
+        "position": "relative",
+        "size": "full",
+        "aspectMode": "cover",
+        "aspectRatio": "1:1",
+        "gravity": "center"
+    },
+    {
+        "type": "box",
+        "layout": "horizontal",
+        "contents": [
+        {
+            "type": "box",
+            "layout": "vertical",
+            "contents": [
+            {
+                "type": "text",
+                "text": "Brown Hotel",
+                "weight": "bold",
+                "size": "xl",
+                "color": "#ffffff"
+            },
+            {
+                "type": "box",
+                "layout": "baseline",
+                "margin": "md",
+                "contents": [
+                {
+                    "type": "icon",
+                    "size": "sm",
+                    "url": "https://scdn.line-apps.com/n/channel_devcenter/img/fx/review_gold_star_28.png"
+                },
+                {
+                    "type": "icon",
+                    "size": "sm",
+                    "url": "https://scdn.line-apps.com/n/channel_devcenter/img/fx/review_gold_star_28.png"
+                },
+                {
+                    "type": "icon",
+                    "size": "sm",
+                    "url": "https://scdn.line-apps.com/n/channel_devcenter/img/fx/review_gold_star_28.png"
+                },
+                {
+                    "type": "icon",
+                    "size": "sm",
+                    "url": "https://scdn.line-apps.com/n/channel_devcenter/img/fx/review_gold_star_28.png"
+                },
+                {
+                    "type": "icon",
+                    "size": "sm",
+                    "url": "https://scdn.line-apps.com/n/channel_devcenter/img/fx/review_gray_star_28.png"
+                },
+                {
+                    "type": "text",
+                    "text": "4.0",
+                    "size": "sm",
+                    "color": "#d6d6d6",
+                    "margin": "md",
+                    "flex": 0
+                }
+                ]
+            }
+            ]
+        },
+        {
+            "type": "box",
+            "layout": "vertical",
+            "contents": [
+            {
+                "type": "text",
+                "text": "¥62,000",
+                "color": "#a9a9a9",
+                "decoration": "line-through",
+                "align": "end"
+            },
+            {
+                "type": "text",
+                "text": "¥42,000",
+                "color": "#ebebeb",
+                "size": "xl",
+                "align": "end"
+            }
+            ]
+        }
+        ],
+        "position": "absolute",
+        "offsetBottom": "0px",
+        "offsetStart": "0px",
+        "offsetEnd": "0px",
+        "backgroundColor": "#00000099",
+        "paddingAll": "20px"
+    },
+    {
+        "type": "box",
+        "layout": "vertical",
+        "contents": [
+        {
+            "type": "text",
+            "text": "SALE",
+            "color": "#ffffff"
+        }
+        ],
+        "position": "absolute",
+        "backgroundColor": "#ff2600",
+        "cornerRadius": "20px",
+        "paddingAll": "5px",
+        "offsetTop": "10px",
+        "offsetEnd": "10px",
+        "paddingStart": "10px",
+        "paddingEnd": "10px"
+    }
+    ],
+    "paddingAll": "0px"
+}
+}
+"""
+flex_update_1_bubble = FlexContainer.from_json(FLEX_UPDATE_1_JSON)
+
+
 @handler.add(MessageEvent, message=TextMessageContent)
 def handle_text_message(event):
     text = event.message.text
-    with ApiClient(configuration) as api_client:
+    record_event(event, 'text:' + text_command_name(text))
+    with shared_api_client() as api_client:
         line_bot_api = MessagingApi(api_client)
         if text == 'profile':
             if isinstance(event.source, UserSource):
-                profile = line_bot_api.get_profile(user_id=event.source.user_id)
+                profile = cached_profile(line_bot_api, event.source.user_id)
                 line_bot_api.reply_message(
                     ReplyMessageRequest(
                         reply_token=event.reply_token,
@@ -244,6 +533,62 @@ def handle_text_message(event):
                     ]
                 )
             )
+        elif text.startswith('narrowcast '):  # narrowcast <audience_group_id>, see audience.py
+            audience_group_id = text.split(' ')[1]
+            if audience_group_id.isdigit():
+                request_id = narrowcast(configuration, int(audience_group_id),
+                                        [TextMessage(text='THIS IS A NARROWCAST MESSAGE')])
+                reply_text = 'Narrowcast request_id: ' + request_id
+            else:
+                reply_text = 'Usage: narrowcast <audience_group_id>'
+            line_bot_api.reply_message(
+                ReplyMessageRequest(
+                    reply_token=event.reply_token,
+                    messages=[TextMessage(text=reply_text)]
+                )
+            )
+        elif text == 'member_count':
+            if isinstance(event.source, (GroupSource, RoomSource)):
+                if membership_index.load(event.source) == MEMBERS_UNAVAILABLE:
+                    reply_text = 'Member IDs are only available to verified or premium accounts'
+                else:
+                    try:
+                        count = membership_index.count(event.source)
+                    except Exception:
+                        app.logger.exception("Failed to count members")
+                        reply_text = 'Member count is not available right now'
+                    else:
+                        reply_text = 'members: ' + str(count) if count is not None else 'Still loading members'
+            else:
+                reply_text = "Bot can't count members of 1:1 chat"
+            line_bot_api.reply_message(
+                ReplyMessageRequest(
+                    reply_token=event.reply_token,
+                    messages=[TextMessage(text=reply_text)]
+                )
+            )
+        elif text == 'rich_menu_progress':
+            progress = rich_menu_assigner.progress()
+            line_bot_api.reply_message(
+                ReplyMessageRequest(
+                    reply_token=event.reply_token,
+                    messages=[TextMessage(text='pending: {}, linked: {}, unlinked: {}, skipped: {}, failed: {}'.format(
+                        progress.pending, progress.linked, progress.unlinked, progress.skipped, progress.failed))]
+                )
+            )
+        elif text == 'stats':
+            if analytics_recorder is not None:
+                analytics_recorder.flush()
+                rows = analytics.top(analytics_dir, days=7, n=5)
+                reply_text = '\n'.join('{}: {}'.format(key, count) for key, count in rows) or 'No usage yet'
+            else:
+                reply_text = 'Analytics is disabled'
+            line_bot_api.reply_message(
+                ReplyMessageRequest(
+                    reply_token=event.reply_token,
+                    messages=[TextMessage(text=reply_text)]
+                )
+            )
         elif text == 'bye':
             if isinstance(event.source, GroupSource):
                 line_bot_api.reply_message(
@@ -271,14 +616,18 @@ def handle_text_message(event):
                     )
                 )
         elif text == 'image':
-            url = request.url_root + '/static/logo.png'
-            url = url.replace("http", "https")
+            url = public_url('static/logo.png')
             app.logger.info("url=" + url)
+            variants = image_variants.request(static_logo_path)
+            if variants is not None:
+                preview_url = public_url('variants/' + variants.key + '/' + PREVIEW_NAME)
+            else:
+                preview_url = url
             line_bot_api.reply_message(
                 ReplyMessageRequest(
                     reply_token=event.reply_token,
                     messages=[
-                        ImageMessage(original_content_url=url, preview_image_url=url)
+                        ImageMessage(original_content_url=url, preview_image_url=preview_url)
                     ]
                 )
             )
@@ -369,7 +718,33 @@ def handle_text_message(event):
                 )
             )
         elif text == 'imagemap':
-            pass
+            variants = image_variants.request(static_logo_path, timeout=IMAGEMAP_WAIT_SECONDS)
+            if variants is None:
+                messages = [TextMessage(text='Imagemap is not ready yet, try again later')]
+            else:
+                height = round(variants.height * IMAGEMAP_BASE_WIDTH / variants.width)
+                half_width = IMAGEMAP_BASE_WIDTH // 2
+                messages = [ImagemapMessage(
+                    base_url=public_url('variants/' + variants.key),
+                    alt_text='Imagemap alt text',
+                    base_size=ImagemapBaseSize(width=IMAGEMAP_BASE_WIDTH, height=height),
+                    actions=[
+                        URIImagemapAction(
+                            link_uri='https://line.me',
+                            area=ImagemapArea(x=0, y=0, width=half_width, height=height)
+                        ),
+                        MessageImagemapAction(
+                            text='hello',
+                            area=ImagemapArea(x=half_width, y=0, width=half_width, height=height)
+                        )
+                    ]
+                )]
+            line_bot_api.reply_message(
+                ReplyMessageRequest(
+                    reply_token=event.reply_token,
+                    messages=messages
+                )
+            )
         elif text == 'flex':
             bubble = FlexBubble(
                 direction='ltr',
@@ -474,132 +849,7 @@ def handle_text_message(event):
                 )
             )
         elif text == 'flex_update_1':
-            bubble_string = """
-            {
-            "type": "bubble",
-            "body": {
-                "type": "box",
-                "layout": "vertical",
-                "contents": [
-                {
-                    "type": "image",
-                    "url": "https://scdn.line-apps.com/n/channel_devcenter/img/flexsnapshot/clip/clip3.jpg",
-                    "position": "relative",
-                    "size": "full",
-                    "aspectMode": "cover",
-                    "aspectRatio": "1:1",
-                    "gravity": "center"
-                },
-                {
-                    "type": "box",
-                    "layout": "horizontal",
-                    "contents": [
-                    {
-                        "type": "box",
-                        "layout": "vertical",
-                        "contents": [
-                        {
-                            "type": "text",
-                            "text": "Brown Hotel",
-                            "weight": "bold",
-                            "size": "xl",
-                            "color": "#ffffff"
-                        },
-                        {
-                            "type": "box",
-                            "layout": "baseline",
-                            "margin": "md",
-                            "contents": [
-                            {
-                                "type": "icon",
-                                "size": "sm",
-                                "url": "https://scdn.line-apps.com/n/channel_devcenter/img/fx/review_gold_star_28.png"
-                            },
-                            {
-                                "type": "icon",
-                                "size": "sm",
-                                "url": "https://scdn.line-apps.com/n/channel_devcenter/img/fx/review_gold_star_28.png"
-                            },
-                            {
-                                "type": "icon",
-                                "size": "sm",
-                                "url": "https://scdn.line-apps.com/n/channel_devcenter/img/fx/review_gold_star_28.png"
-                            },
-                            {
-                                "type": "icon",
-                                "size": "sm",
-                                "url": "https://scdn.line-apps.com/n/channel_devcenter/img/fx/review_gold_star_28.png"
-                            },
-                            {
-                                "type": "icon",
-                                "size": "sm",
-                                "url": "https://scdn.line-apps.com/n/channel_devcenter/img/fx/review_gray_star_28.png"
-                            },
-                            {
-                                "type": "text",
-                                "text": "4.0",
-                                "size": "sm",
-                                "color": "#d6d6d6",
-                                "margin": "md",
-                                "flex": 0
-                            }
-                            ]
-                        }
-                        ]
-                    },
-                    {
-                        "type": "box",
-                        "layout": "vertical",
-                        "contents": [
-                        {
-                            "type": "text",
-                            "text": "¥62,000",
-                            "color": "#a9a9a9",
-                            "decoration": "line-through",
-                            "align": "end"
-                        },
-                        {
-                            "type": "text",
-                            "text": "¥42,000",
-                            "color": "#ebebeb",
-                            "size": "xl",
-                            "align": "end"
-                        }
-                        ]
-                    }
-                    ],
-                    "position": "absolute",
-                    "offsetBottom": "0px",
-                    "offsetStart": "0px",
-                    "offsetEnd": "0px",
-                    "backgroundColor": "#00000099",
-                    "paddingAll": "20px"
-                },
-                {
-                    "type": "box",
-                    "layout": "vertical",
-                    "contents": [
-                    {
-                        "type": "text",
-                        "text": "SALE",
-                        "color": "#ffffff"
-                    }
-                    ],
-                    "position": "absolute",
-                    "backgroundColor": "#ff2600",
-                    "cornerRadius": "20px",
-                    "paddingAll": "5px",
-                    "offsetTop": "10px",
-                    "offsetEnd": "10px",
-                    "paddingStart": "10px",
-                    "paddingEnd": "10px"
-                }
-                ],
-                "paddingAll": "0px"
-            }
-            }
-            """
-            message = FlexMessage(alt_text="hello", contents=FlexContainer.from_json(bubble_string))
+            message = FlexMessage(alt_text="hello", contents=flex_update_1_bubble)
             line_bot_api.reply_message(
                 ReplyMessageRequest(
                     reply_token=event.reply_token,
@@ -732,24 +982,36 @@ def handle_text_message(event):
 
 @handler.add(MessageEvent, message=LocationMessageContent)
 def handle_location_message(event):
-    with ApiClient(configuration) as api_client:
+    record_event(event, 'location')
+    with shared_api_client() as api_client:
         line_bot_api = MessagingApi(api_client)
+        if not store_index:
+            messages = [LocationMessage(
+                title='Location',
+                address=event.message.address,
+                latitude=event.message.latitude,
+                longitude=event.message.longitude
+            )]
+        else:
+            stores = store_index.nearest(event.message.latitude, event.message.longitude, k=NEAREST_STORE_COUNT)
+            messages = [LocationMessage(
+                title='{} ({:.1f} km)'.format(store.name, store.distance / 1000),
+                address=store.address or store.name,
+                latitude=store.latitude,
+                longitude=store.longitude
+            ) for store in stores]
         line_bot_api.reply_message(
             ReplyMessageRequest(
                 reply_token=event.reply_token,
-                messages=[LocationMessage(
-                    title='Location',
-                    address=event.message.address,
-                    latitude=event.message.latitude,
-                    longitude=event.message.longitude
-                )]
+                messages=messages
             )
         )
 
 
 @handler.add(MessageEvent, message=StickerMessageContent)
 def handle_sticker_message(event):
-    with ApiClient(configuration) as api_client:
+    record_event(event, 'sticker')
+    with shared_api_client() as api_client:
         line_bot_api = MessagingApi(api_client)
         line_bot_api.reply_message(
             ReplyMessageRequest(
@@ -775,8 +1037,9 @@ def handle_content_message(event):
         ext = 'm4a'
     else:
         return
+    record_event(event, 'content:' + ext)
 
-    with ApiClient(configuration) as api_client:
+    with shared_api_client() as api_client:
         line_bot_blob_api = MessagingApiBlob(api_client)
         message_content = line_bot_blob_api.get_message_content(message_id=event.message.id)
         with tempfile.NamedTemporaryFile(dir=static_tmp_path, prefix=ext + '-', delete=False) as tf:
@@ -786,23 +1049,33 @@ def handle_content_message(event):
     dist_path = tempfile_path + '.' + ext
     dist_name = os.path.basename(dist_path)
     os.rename(tempfile_path, dist_path)
+    messages = [
+        TextMessage(text='Save content.'),
+        TextMessage(text=request.host_url + os.path.join('static', 'tmp', dist_name))
+    ]
+    if ext == 'jpg':
+        # show the saved image back with its preview if that is quick
+        variants = image_variants.request(dist_path, timeout=CONTENT_PREVIEW_WAIT_SECONDS)
+        if variants is not None:
+            messages.append(ImageMessage(
+                original_content_url=public_url('static/tmp/' + dist_name),
+                preview_image_url=public_url('variants/' + variants.key + '/' + PREVIEW_NAME)
+            ))
 
-    with ApiClient(configuration) as api_client:
+    with shared_api_client() as api_client:
         line_bot_api = MessagingApi(api_client)
         line_bot_api.reply_message(
             ReplyMessageRequest(
                 reply_token=event.reply_token,
-                messages=[
-                    TextMessage(text='Save content.'),
-                    TextMessage(text=request.host_url + os.path.join('static', 'tmp', dist_name))
-                ]
+                messages=messages
             )
         )
 
 
 @handler.add(MessageEvent, message=FileMessageContent)
 def handle_file_message(event):
-    with ApiClient(configuration) as api_client:
+    record_event(event, 'file')
+    with shared_api_client() as api_client:
         line_bot_blob_api = MessagingApiBlob(api_client)
         message_content = line_bot_blob_api.get_message_content(message_id=event.message.id)
         with tempfile.NamedTemporaryFile(dir=static_tmp_path, prefix='file-', delete=False) as tf:
@@ -813,7 +1086,7 @@ def handle_file_message(event):
     dist_name = os.path.basename(dist_path)
     os.rename(tempfile_path, dist_path)
 
-    with ApiClient(configuration) as api_client:
+    with shared_api_client() as api_client:
         line_bot_api = MessagingApi(api_client)
         line_bot_api.reply_message(
             ReplyMessageRequest(
@@ -828,8 +1101,11 @@ def handle_file_message(event):
 
 @handler.add(FollowEvent)
 def handle_follow(event):
+    record_event(event, 'follow')
     app.logger.info("Got Follow event:" + event.source.user_id)
-    with ApiClient(configuration) as api_client:
+    if default_rich_menu_id:
+        rich_menu_assigner.assign(event.source.user_id, default_rich_menu_id)
+    with shared_api_client() as api_client:
         line_bot_api = MessagingApi(api_client)
         line_bot_api.reply_message(
             ReplyMessageRequest(
@@ -841,12 +1117,15 @@ def handle_follow(event):
 
 @handler.add(UnfollowEvent)
 def handle_unfollow(event):
+    record_event(event, 'unfollow')
     app.logger.info("Got Unfollow event:" + event.source.user_id)
+    rich_menu_assigner.forget(event.source.user_id)
 
 
 @handler.add(JoinEvent)
 def handle_join(event):
-    with ApiClient(configuration) as api_client:
+    record_event(event, 'join')
+    with shared_api_client() as api_client:
         line_bot_api = MessagingApi(api_client)
         line_bot_api.reply_message(
             ReplyMessageRequest(
@@ -854,56 +1133,77 @@ def handle_join(event):
                 messages=[TextMessage(text='Joined this ' + event.source.type)]
             )
         )
+    membership_index.load(event.source)
 
 
 @handler.add(LeaveEvent)
-def handle_leave():
+def handle_leave(event):
+    record_event(event, 'leave')
     app.logger.info("Got leave event")
+    membership_index.drop(event.source)
 
 
 @handler.add(PostbackEvent)
 def handle_postback(event: PostbackEvent):
-    with ApiClient(configuration) as api_client:
+    record_event(event, 'postback')
+    with shared_api_client() as api_client:
         line_bot_api = MessagingApi(api_client)
-        if event.postback.data == 'ping':
-            line_bot_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text='pong')]
-                )
-            )
-        elif event.postback.data == 'datetime_postback':
-            line_bot_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text=event.postback.params['datetime'])]
-                )
-            )
-        elif event.postback.data == 'date_postback':
-            line_bot_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text=event.postback.params['date'])]
-                )
-            )
+        if not postback_router.dispatch(event, line_bot_api):
+            app.logger.info("Unhandled postback data: " + event.postback.data)
+
+
+@postback_router.add('ping')
+def postback_ping(event, postback, line_bot_api):
+    line_bot_api.reply_message(
+        ReplyMessageRequest(
+            reply_token=event.reply_token,
+            messages=[TextMessage(text='pong')]
+        )
+    )
+
+
+@postback_router.add('datetime_postback')
+def postback_datetime(event, postback, line_bot_api):
+    line_bot_api.reply_message(
+        ReplyMessageRequest(
+            reply_token=event.reply_token,
+            messages=[TextMessage(text=postback.picker['datetime'])]
+        )
+    )
+
+
+@postback_router.add('date_postback')
+def postback_date(event, postback, line_bot_api):
+    line_bot_api.reply_message(
+        ReplyMessageRequest(
+            reply_token=event.reply_token,
+            messages=[TextMessage(text=postback.picker['date'])]
+        )
+    )
 
 
 @handler.add(BeaconEvent)
 def handle_beacon(event: BeaconEvent):
-    with ApiClient(configuration) as api_client:
+    record_event(event, 'beacon:' + event.beacon.type)
+    visit = beacon_aggregator.add(getattr(event.source, 'user_id', None), event.beacon.hwid, event.beacon.type)
+    if not visit.emit:
+        return
+    with shared_api_client() as api_client:
         line_bot_api = MessagingApi(api_client)
         line_bot_api.reply_message(
             ReplyMessageRequest(
                 reply_token=event.reply_token,
-                messages=[TextMessage(text='Got beacon event. hwid={}, device_message(hex string)={}'.format(
-                    event.beacon.hwid, event.beacon.dm))]
+                messages=[TextMessage(text='Got beacon event. hwid={}, device_message(hex string)={}, visits={}'.format(
+                    event.beacon.hwid, event.beacon.dm, visit.visits))]
             )
         )
 
 
 @handler.add(MemberJoinedEvent)
 def handle_member_joined(event):
-    with ApiClient(configuration) as api_client:
+    record_event(event, 'member_joined')
+    membership_index.add(event.source, [member.user_id for member in event.joined.members])
+    with shared_api_client() as api_client:
         line_bot_api = MessagingApi(api_client)
         line_bot_api.reply_message(
             ReplyMessageRequest(
@@ -915,11 +1215,14 @@ def handle_member_joined(event):
 
 @handler.add(MemberLeftEvent)
 def handle_member_left(event):
+    record_event(event, 'member_left')
     app.logger.info("Got memberLeft event")
+    membership_index.remove(event.source, [member.user_id for member in event.left.members])
 
 
 @handler.add(UnknownEvent)
 def handle_unknown_left(event):
+    record_event(event, 'unknown')
     app.logger.info(f"unknown event {event}")
 
 
@@ -928,6 +1231,21 @@ def send_static_content(path):
     return send_from_directory('static', path)
 
 
+@app.route('/variants/<key>/<name>')
+def send_image_variant(key, name):
+    return send_from_directory(image_variants.directory(key), name, mimetype='image/jpeg')
+
+
+warm_up()
+
+# opt-in memory/CPU profiling routes, see profiling.py; nothing is
+# instrumented unless PROFILING_TOKEN is set
+profiling_token = os.getenv('PROFILING_TOKEN', None)
+if profiling_token:
+    import profiling
+    profiling.install(app, handler, profiling_token, store=kv_store)
+
+
 if __name__ == "__main__":
     arg_parser = ArgumentParser(
         usage='Usage: python ' + __file__ + ' [--port <port>] [--help]'
@@ -936,7 +1254,8 @@ if __name__ == "__main__":
     arg_parser.add_argument('-d', '--debug', default=False, help='debug')
     options = arg_parser.parse_args()
 
-    # create tmp dir for download content
-    make_static_tmp_dir()
+    # development server only; for production run gunicorn, which picks up
+    # gunicorn.conf.py: gunicorn app:app
+    init_worker()
 
     app.run(debug=options.debug, port=options.port)
\ No newline at end of file
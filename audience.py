@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+
+#  Licensed under the Apache License, Version 2.0 (the "License"); you may
+#  not use this file except in compliance with the License. You may obtain
+#  a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#  License for the specific language governing permissions and limitations
+#  under the License.
+
+"""Upload an audience of user IDs from a large CSV file.
+
+User IDs are read from the first column of the file, deduplicated and
+uploaded in chunks of CHUNK_SIZE. The first chunk creates the audience
+group and the rest are added by a bounded number of parallel requests, so
+memory use does not grow with the file. Progress is saved next to the file
+in <file>.upload.json and an interrupted upload resumes from it:
+
+    python audience.py users.csv --description 'spring campaign' [--narrowcast 'Hello']
+
+LINE_CHANNEL_ACCESS_TOKEN must be set as for app.py.
+"""
+
+import csv
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+
+import urllib3
+from linebot.v3.audience import (
+    ApiClient as AudienceClient,
+    ApiException,
+    ManageAudience,
+    CreateAudienceGroupRequest,
+    AddAudienceToAudienceGroupRequest,
+    Audience
+)
+from linebot.v3.messaging import (
+    Configuration,
+    ApiClient,
+    MessagingApi,
+    NarrowcastRequest,
+    AudienceRecipient,
+    TextMessage
+)
+
+
+CHUNK_SIZE = 10000
+MAX_RETRIES = 5
+USER_ID_PATTERN = re.compile(r'^U[0-9a-f]{32}$')
+
+logger = logging.getLogger(__name__)
+
+
+class UserIdSet(object):
+    """Open-addressing hash set of user IDs stored as 16 raw bytes each.
+
+    A slot is 16 bytes and the load factor stays between 0.3 (just after
+    growing) and 0.6, so an ID costs 27 to 53 bytes, against well over 100
+    for a set of str.
+    """
+
+    _EMPTY = bytes(16)
+
+    def __init__(self, capacity=1 << 16):
+        self._capacity = capacity
+        self._slots = bytearray(16 * capacity)
+        self._size = 0
+        self._has_empty_key = False
+
+    def __len__(self):
+        return self._size
+
+    def _insert(self, key):
+        mask = self._capacity - 1
+        i = int.from_bytes(key[:8], 'little') & mask
+        slots = self._slots
+        while True:
+            slot = slots[16 * i:16 * i + 16]
+            if slot == self._EMPTY:
+                slots[16 * i:16 * i + 16] = key
+                return True
+            if slot == key:
+                return False
+            i = (i + 1) & mask
+
+    def add(self, user_id):
+        """Add user_id ('U' + 32 hex digits) and return True if it was new."""
+        key = bytes.fromhex(user_id[1:])
+        if key == self._EMPTY:
+            added, self._has_empty_key = not self._has_empty_key, True
+        else:
+            added = self._insert(key)
+        if added:
+            self._size += 1
+            if self._size * 10 > self._capacity * 6:
+                self._grow()
+        return added
+
+    def _grow(self):
+        old_slots, old_capacity = self._slots, self._capacity
+        self._capacity *= 2
+        self._slots = bytearray(16 * self._capacity)
+        for i in range(old_capacity):
+            key = bytes(old_slots[16 * i:16 * i + 16])
+            if key != self._EMPTY:
+                self._insert(key)
+
+
+def read_user_ids(path):
+    """Yield valid user IDs from the first column of path, skipping others."""
+    with open(path, newline='', encoding='utf-8') as f:
+        for row in csv.reader(f):
+            if row and USER_ID_PATTERN.match(row[0].strip()):
+                yield row[0].strip()
+
+
+def unique_chunks(user_ids, size=CHUNK_SIZE):
+    seen = UserIdSet()
+    chunk = []
+    for user_id in user_ids:
+        if seen.add(user_id):
+            chunk.append(user_id)
+            if len(chunk) == size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+
+class UploadState(object):
+
+    def __init__(self, path, source_path):
+        self.path = path
+        st = os.stat(source_path)
+        self._source = [os.path.abspath(source_path), st.st_size, st.st_mtime_ns]
+        self.audience_group_id = None
+        self.done = set()
+        self._lock = threading.Lock()
+        try:
+            with open(path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return
+        if state.get('source') == self._source:
+            self.audience_group_id = state['audience_group_id']
+            self.done = set(state['done'])
+
+    def mark_done(self, index):
+        with self._lock:
+            self.done.add(index)
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump({'source': self._source, 'audience_group_id': self.audience_group_id,
+                           'done': sorted(self.done)}, f)
+            os.replace(tmp_path, self.path)
+
+
+def _is_transient(error):
+    if isinstance(error, ApiException):
+        return error.status == 429 or (error.status or 0) >= 500
+    return isinstance(error, (OSError, urllib3.exceptions.HTTPError))
+
+
+def _with_retries(func, *args):
+    """Call func, retrying network errors, 5xx and 429 with backoff."""
+    for attempt in range(MAX_RETRIES):
+        try:
+            return func(*args)
+        except Exception as e:
+            if attempt + 1 == MAX_RETRIES or not _is_transient(e):
+                raise
+            logger.warning("Audience request failed, retrying", exc_info=True)
+            time.sleep(2 ** attempt)
+
+
+def upload_audience(configuration, path, description, parallel=4):
+    """Upload the user IDs in path and return the audience group ID.
+
+    Raises the last error if a chunk still fails after MAX_RETRIES; running
+    it again with the same file resumes the upload.
+    """
+    state = UploadState(path + '.upload.json', path)
+    failures = []
+    with AudienceClient(configuration) as api_client:
+        audience_api = ManageAudience(api_client)
+
+        def add_chunk(index, chunk):
+            try:
+                _with_retries(audience_api.add_audience_to_audience_group, AddAudienceToAudienceGroupRequest(
+                    audience_group_id=state.audience_group_id,
+                    upload_description='{} #{}'.format(os.path.basename(path), index),
+                    audiences=[Audience(id=user_id) for user_id in chunk]
+                ))
+            except Exception as e:
+                failures.append(e)
+                return
+            state.mark_done(index)
+            logger.info("Uploaded chunk %d of %s", index, path)
+
+        # bounds the chunks held in memory to twice the parallel requests
+        in_flight = threading.BoundedSemaphore(2 * parallel)
+        with ThreadPoolExecutor(max_workers=parallel, thread_name_prefix='audience') as executor:
+            for index, chunk in enumerate(unique_chunks(read_user_ids(path))):
+                if index in state.done:
+                    continue
+                if state.audience_group_id is None:
+                    response = _with_retries(audience_api.create_audience_group, CreateAudienceGroupRequest(
+                        description=description,
+                        is_ifa_audience=False,
+                        upload_description='{} #0'.format(os.path.basename(path)),
+                        audiences=[Audience(id=user_id) for user_id in chunk]
+                    ))
+                    state.audience_group_id = response.audience_group_id
+                    state.mark_done(index)
+                    continue
+                in_flight.acquire()
+                future = executor.submit(add_chunk, index, chunk)
+                future.add_done_callback(lambda _: in_flight.release())
+
+    if failures:
+        raise failures[0]
+    return state.audience_group_id
+
+
+def narrowcast(configuration, audience_group_id, messages):
+    """Send messages to the audience and return the request ID for progress lookups."""
+    with ApiClient(configuration) as api_client:
+        line_bot_api = MessagingApi(api_client)
+        response = line_bot_api.narrowcast_with_http_info(
+            NarrowcastRequest(
+                messages=messages,
+                recipient=AudienceRecipient(type='audience', audience_group_id=audience_group_id)
+            )
+        )
+        return response.headers['x-line-request-id']
+
+
+if __name__ == '__main__':
+    arg_parser = ArgumentParser(
+        usage='Usage: python ' + __file__ + ' <file> --description <text> [--parallel <n>] [--narrowcast <text>]'
+    )
+    arg_parser.add_argument('file', help='CSV file with user IDs in the first column')
+    arg_parser.add_argument('--description', required=True, help='audience name')
+    arg_parser.add_argument('--parallel', type=int, default=4, help='concurrent upload requests')
+    arg_parser.add_argument('--narrowcast', default=None, help='send this text to the audience after uploading')
+    options = arg_parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    channel_access_token = os.getenv('LINE_CHANNEL_ACCESS_TOKEN', None)
+    if channel_access_token is None:
+        print('Specify LINE_CHANNEL_ACCESS_TOKEN as environment variable.')
+        sys.exit(1)
+    configuration = Configuration(access_token=channel_access_token)
+
+    audience_group_id = upload_audience(configuration, options.file, options.description, options.parallel)
+    print('audience_group_id: {}'.format(audience_group_id))
+    if options.narrowcast:
+        request_id = narrowcast(configuration, audience_group_id, [TextMessage(text=options.narrowcast)])
+        print('narrowcast request_id: {}'.format(request_id))
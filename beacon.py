@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+#  Licensed under the Apache License, Version 2.0 (the "License"); you may
+#  not use this file except in compliance with the License. You may obtain
+#  a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#  License for the specific language governing permissions and limitations
+#  under the License.
+
+"""Windowed aggregation of beacon events per (user_id, hwid, beacon type).
+
+Each type (enter, leave, banner, stay) is debounced on its own, so a leave
+never uses up the window of the next enter.
+
+Time is cut into fixed windows of `window` seconds. The first event of a
+key in a window is emitted, later ones in the same window are collapsed.
+Each key keeps a bitmask of the last `history` windows it was seen in, so
+the rolling visit count is a popcount and an entry costs a few ints.
+Keys are kept in LRU order and the least recently seen key is evicted
+once `max_keys` is reached.
+
+With a shared `store` (see kvstore.py) an event this process would emit
+also has to claim its window there, so at most one event per key and
+window is emitted across all workers and nodes. Only the first event of a
+key in a window costs a round trip; visit counts remain per process. If
+the store fails, the local decision stands.
+"""
+
+import logging
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+
+logger = logging.getLogger(__name__)
+
+BeaconVisit = namedtuple('BeaconVisit', ['emit', 'visits', 'collapsed'])
+
+
+class _Entry(object):
+    __slots__ = ('window', 'mask', 'collapsed')
+
+    def __init__(self, window):
+        self.window = window
+        self.mask = 1
+        self.collapsed = 0
+
+
+class BeaconAggregator(object):
+
+    def __init__(self, window=60, history=60, max_keys=100000, store=None):
+        self.window = window
+        self.history = history
+        self.max_keys = max_keys
+        self.store = store
+        self._mask = (1 << history) - 1
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, user_id, hwid, beacon_type='enter', now=None):
+        window = int((time.time() if now is None else now) // self.window)
+        visit = self._add_local((user_id, hwid, beacon_type), window)
+        if visit.emit and self.store is not None:
+            try:
+                claimed = self.store.add('beacon:{}:{}:{}:{}'.format(user_id, hwid, beacon_type, window), b'1', ttl=self.window)
+            except Exception:
+                logger.exception('Failed to claim beacon window, deciding locally')
+            else:
+                if not claimed:
+                    return visit._replace(emit=False)
+        return visit
+
+    def _add_local(self, key, window):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                if len(self._entries) >= self.max_keys:
+                    self._entries.popitem(last=False)
+                self._entries[key] = _Entry(window)
+                return BeaconVisit(True, 1, 0)
+
+            self._entries.move_to_end(key)
+            if window <= entry.window:
+                entry.collapsed += 1
+                return BeaconVisit(False, bin(entry.mask).count('1'), entry.collapsed)
+
+            shift = window - entry.window
+            entry.mask = ((entry.mask << shift) | 1) & self._mask if shift < self.history else 1
+            entry.window = window
+            collapsed, entry.collapsed = entry.collapsed, 0
+            return BeaconVisit(True, bin(entry.mask).count('1'), collapsed)
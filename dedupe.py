@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+#  Licensed under the Apache License, Version 2.0 (the "License"); you may
+#  not use this file except in compliance with the License. You may obtain
+#  a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#  License for the specific language governing permissions and limitations
+#  under the License.
+
+"""Drop webhook events that were already handled, on any node.
+
+DeduplicatingParser wraps WebhookHandler.parser. After the signature is
+checked it looks up the webhookEventId of every event in the body with a
+single get_many() on the shared key-value backend, so one webhook costs
+one round trip however many events it carries, and removes events that
+were handled before. The IDs are only recorded by handled(), called once
+the webhook was handled, so a redelivery after a failed or killed worker
+is handled again. If the backend fails, every event is kept.
+"""
+
+import logging
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+class DeduplicatingParser(object):
+
+    def __init__(self, parser, store, ttl=24 * 60 * 60):
+        self.parser = parser
+        self.store = store
+        self.ttl = ttl
+        self._local = threading.local()
+
+    def __getattr__(self, name):
+        return getattr(self.parser, name)
+
+    def parse(self, body, signature, as_payload=False):
+        payload = self.parser.parse(body, signature, as_payload=True)
+        keys = {}
+        for event in payload.events:
+            event_id = getattr(event, 'webhook_event_id', None)
+            if event_id:
+                keys[id(event)] = 'event:' + event_id
+        self._local.keys = list(keys.values())
+
+        if keys:
+            try:
+                handled = self.store.get_many(keys.values())
+            except Exception:
+                logger.exception('Failed to check webhook event IDs, handling all events')
+            else:
+                events = [event for event in payload.events if keys.get(id(event)) not in handled]
+                if len(events) != len(payload.events):
+                    logger.info('Skipped %d redelivered events', len(payload.events) - len(events))
+                payload.events = events
+
+        return payload if as_payload else payload.events
+
+    def handled(self):
+        """Record the events of the last parse() on this thread as handled."""
+        keys, self._local.keys = getattr(self._local, 'keys', None), None
+        if not keys:
+            return
+        try:
+            self.store.set_many(dict.fromkeys(keys, b'1'), self.ttl)
+        except Exception:
+            logger.exception('Failed to record handled webhook event IDs')
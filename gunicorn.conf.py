@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+#  Licensed under the Apache License, Version 2.0 (the "License"); you may
+#  not use this file except in compliance with the License. You may obtain
+#  a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#  License for the specific language governing permissions and limitations
+#  under the License.
+
+"""Gunicorn settings, picked up from the working directory:
+
+    gunicorn app:app
+
+The app is imported once in the master (preload_app), which runs
+app.warm_up(): the store index, parsed templates and image variants are
+loaded before forking and shared copy-on-write by the workers. gc.freeze()
+before each fork keeps the garbage collector from touching, and so
+copying, those pages in the workers.
+
+Webhook handlers mostly wait on the LINE API, so each worker runs a pool
+of threads. Defaults are one worker per CPU and 8 threads per worker;
+override with WEB_CONCURRENCY and GUNICORN_THREADS.
+
+State shared through kv_store (webhook dedupe, member index, beacon
+windows, rich menu links) must not live in each worker's memory, so with
+more than one worker KV_URL defaults to a SQLite file shared by the
+workers of this host. Set KV_URL to a redis:// URL for several hosts.
+
+Reloading: with preload_app, SIGHUP restarts the workers gracefully but
+keeps the code loaded in the master. To deploy new code without dropping
+webhooks, send SIGUSR2 (starts a new master and workers next to the old
+ones), then SIGWINCH and SIGQUIT to the old master once the new one is
+ready; in-flight requests get graceful_timeout seconds to finish.
+"""
+
+import gc
+import multiprocessing
+import os
+
+
+bind = '0.0.0.0:' + os.getenv('PORT', '8000')
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+threads = int(os.getenv('GUNICORN_THREADS', '8'))
+worker_class = 'gthread' if threads > 1 else 'sync'
+preload_app = True
+timeout = 30
+graceful_timeout = 30
+keepalive = 5
+
+# recycle workers now and then to bound slow RSS growth; 0 disables
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', '0'))
+max_requests_jitter = max_requests // 10
+
+if workers > 1:
+    os.environ.setdefault('KV_URL', 'sqlite:///' + os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'var', 'kv.sqlite3'))
+
+
+def on_starting(server):
+    if workers > 1 and os.environ['KV_URL'].startswith('memory:'):
+        server.log.warning('KV_URL=%s is per worker; dedupe and shared state differ between the %d workers',
+                           os.environ['KV_URL'], workers)
+
+
+def pre_fork(server, worker):
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    import app
+    app.init_worker()
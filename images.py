@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+#  Licensed under the Apache License, Version 2.0 (the "License"); you may
+#  not use this file except in compliance with the License. You may obtain
+#  a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#  License for the specific language governing permissions and limitations
+#  under the License.
+
+"""Preview and imagemap variants of images, generated on a process pool.
+
+Variants of an image are written to <cache_dir>/<key>/, where key depends
+on the source path, size and mtime:
+
+    preview.jpg    fits in PREVIEW_SIZE x PREVIEW_SIZE
+    240 ... 1040   imagemap base images, named by width as LINE requests them
+    meta.json      source width and height, written last to mark completion
+"""
+
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import threading
+from collections import namedtuple
+from concurrent import futures
+
+
+PREVIEW_SIZE = 240
+IMAGEMAP_WIDTHS = (240, 300, 460, 700, 1040)
+META_NAME = 'meta.json'
+PREVIEW_NAME = 'preview.jpg'
+
+logger = logging.getLogger(__name__)
+
+Variants = namedtuple('Variants', ['key', 'width', 'height'])
+
+
+def variant_key(src_path):
+    st = os.stat(src_path)
+    source = '{}:{}:{}'.format(os.path.abspath(src_path), st.st_size, st.st_mtime_ns)
+    return hashlib.sha1(source.encode('utf-8')).hexdigest()[:20]
+
+
+def _save(image, path, **kwargs):
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    image.save(tmp_path, 'JPEG', **kwargs)
+    os.replace(tmp_path, path)
+
+
+def generate_variants(src_path, out_dir):
+    # runs in a pool process
+    from PIL import Image
+
+    os.makedirs(out_dir, exist_ok=True)
+    with Image.open(src_path) as source:
+        if source.mode in ('RGBA', 'LA', 'P'):
+            source = source.convert('RGBA')
+            image = Image.new('RGB', source.size, (255, 255, 255))
+            image.paste(source, mask=source.getchannel('A'))
+        else:
+            image = source.convert('RGB')
+
+    for width in IMAGEMAP_WIDTHS:
+        height = max(1, round(image.height * width / image.width))
+        _save(image.resize((width, height), Image.LANCZOS),
+              os.path.join(out_dir, str(width)), quality=85, optimize=True)
+
+    preview = image.copy()
+    preview.thumbnail((PREVIEW_SIZE, PREVIEW_SIZE), Image.LANCZOS)
+    _save(preview, os.path.join(out_dir, PREVIEW_NAME), quality=80, optimize=True)
+
+    meta_path = os.path.join(out_dir, META_NAME)
+    with open(meta_path + '.tmp', 'w') as f:
+        json.dump({'width': image.width, 'height': image.height}, f)
+    os.replace(meta_path + '.tmp', meta_path)
+    return image.width, image.height
+
+
+class ImageVariants(object):
+
+    def __init__(self, cache_dir, max_workers=2):
+        self.cache_dir = cache_dir
+        self.max_workers = max_workers
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def _read_meta(self, key):
+        try:
+            with open(os.path.join(self.cache_dir, key, META_NAME)) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return Variants(key, meta['width'], meta['height'])
+
+    def _submit(self, key, src_path):
+        with self._lock:
+            if self._pid != os.getpid():
+                # the pool is created lazily so that it belongs to the worker;
+                # its processes come from a forkserver, as forking a
+                # multi-threaded worker can copy locks held by other threads
+                self._executor = futures.ProcessPoolExecutor(
+                    max_workers=self.max_workers, mp_context=multiprocessing.get_context('forkserver'))
+                self._futures = {}
+                self._pid = os.getpid()
+            future = self._futures.get(key)
+            if future is None:
+                future = self._executor.submit(generate_variants, src_path, os.path.join(self.cache_dir, key))
+                future.add_done_callback(lambda _: self._futures.pop(key, None))
+                self._futures[key] = future
+            return future
+
+    def request(self, src_path, timeout=0):
+        """Return the Variants of src_path, scheduling generation if needed.
+
+        Waits up to timeout seconds for a pending generation and returns
+        None if the variants are not ready by then or cannot be generated.
+        """
+        try:
+            key = variant_key(src_path)
+        except OSError:
+            return None
+        variants = self._read_meta(key)
+        if variants is not None:
+            return variants
+        future = self._submit(key, src_path)
+        try:
+            width, height = future.result(timeout=timeout)
+        except futures.TimeoutError:
+            return None
+        except Exception:
+            logger.exception('Failed to generate image variants of ' + src_path)
+            return None
+        return Variants(key, width, height)
+
+    def warm(self, src_path):
+        """Generate missing variants of src_path in this process, without the pool."""
+        try:
+            key = variant_key(src_path)
+        except OSError:
+            return None
+        variants = self._read_meta(key)
+        if variants is not None:
+            return variants
+        try:
+            width, height = generate_variants(src_path, self.directory(key))
+        except Exception:
+            logger.exception('Failed to generate image variants of ' + src_path)
+            return None
+        return Variants(key, width, height)
+
+    def directory(self, key):
+        return os.path.join(self.cache_dir, key)
@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+
+#  Licensed under the Apache License, Version 2.0 (the "License"); you may
+#  not use this file except in compliance with the License. You may obtain
+#  a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#  License for the specific language governing permissions and limitations
+#  under the License.
+
+"""Append-only journal of webhook request bodies.
+
+Each process run writes to its own subdirectory (named after its start
+time, pid and a random suffix) so that gunicorn workers never share a file
+and a restarted process never takes over the checkpoint of a crashed one.
+A subdirectory holds segment files named after the journal offset of their
+first record, a `checkpoint` file with the offset below which every record
+has been handled, and a `failed` file with the offsets of records whose
+handling raised, so that they do not hold back the checkpoint:
+
+    <directory>/20240220T101500-<pid>-<random>/00000000000067108912.seg
+    <directory>/20240220T101500-<pid>-<random>/00000000000134217824.seg
+    <directory>/20240220T101500-<pid>-<random>/checkpoint
+    <directory>/20240220T101500-<pid>-<random>/failed
+
+A record is a '<IId' header (length, crc32, unix time) followed by the
+body. Every record is flushed to the OS as it is appended, so it survives
+the process being killed; fsyncs (for surviving a host crash) are batched,
+every `fsync_every` records or every `fsync_interval` seconds, whichever
+comes first. Segments wholly below the checkpoint and holding no failed
+record are deleted, and the directory of a run is removed on close() once
+all of it is handled. A torn
+record left by a crash ends the records readers see in that segment.
+"""
+
+import atexit
+import logging
+import os
+import shutil
+import struct
+import threading
+import time
+import uuid
+import zlib
+
+
+RECORD_HEADER = struct.Struct('<IId')
+SEGMENT_SUFFIX = '.seg'
+CHECKPOINT_NAME = 'checkpoint'
+FAILED_NAME = 'failed'
+
+logger = logging.getLogger(__name__)
+
+
+def _segments(path):
+    names = sorted(n for n in os.listdir(path) if n.endswith(SEGMENT_SUFFIX))
+    return [(int(n[:-len(SEGMENT_SUFFIX)]), os.path.join(path, n)) for n in names]
+
+
+def _scan(f, base):
+    """Yield (offset, timestamp, body) from a segment until its valid end."""
+    position = 0
+    while True:
+        header = f.read(RECORD_HEADER.size)
+        if len(header) < RECORD_HEADER.size:
+            return
+        length, crc, timestamp = RECORD_HEADER.unpack(header)
+        body = f.read(length)
+        if len(body) < length or zlib.crc32(body) != crc:
+            return
+        yield base + position, timestamp, body
+        position += RECORD_HEADER.size + length
+
+
+def _write_atomic(path, name, text):
+    tmp_path = os.path.join(path, name + '.tmp')
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    os.replace(tmp_path, os.path.join(path, name))
+
+
+def read_checkpoint(path):
+    try:
+        with open(os.path.join(path, CHECKPOINT_NAME)) as f:
+            return int(f.read().strip() or 0)
+    except FileNotFoundError:
+        return 0
+
+
+def write_checkpoint(path, offset):
+    _write_atomic(path, CHECKPOINT_NAME, str(offset))
+
+
+def read_failed(path):
+    """Return the set of offsets of records whose handling failed."""
+    try:
+        with open(os.path.join(path, FAILED_NAME)) as f:
+            return {int(line) for line in f.read().split()}
+    except FileNotFoundError:
+        return set()
+
+
+def write_failed(path, offsets):
+    if offsets:
+        _write_atomic(path, FAILED_NAME, ''.join('%d\n' % offset for offset in sorted(offsets)))
+    else:
+        try:
+            os.remove(os.path.join(path, FAILED_NAME))
+        except FileNotFoundError:
+            pass
+
+
+def run_pid(path):
+    """Return the pid of the process that wrote the journal directory path."""
+    try:
+        return int(os.path.basename(path).split('-')[1])
+    except (IndexError, ValueError):
+        return None
+
+
+def is_running(path):
+    """Return True if the process that wrote path may still be appending."""
+    pid = run_pid(path)
+    if pid is None or pid == os.getpid():
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def journal_dirs(directory):
+    """Return the per-process journal directories under directory."""
+    if not os.path.isdir(directory):
+        return []
+    return sorted(os.path.join(directory, n) for n in os.listdir(directory)
+                  if os.path.isdir(os.path.join(directory, n)))
+
+
+def remove_handled_segments(path, checkpoint, failed=()):
+    # a segment can go once the next one starts at or below the checkpoint
+    # and none of its records failed; the last segment is always kept
+    segments = _segments(path)
+    for (base, segment_path), (next_base, _) in zip(segments, segments[1:]):
+        if next_base > checkpoint:
+            break
+        if not any(base <= offset < next_base for offset in failed):
+            os.remove(segment_path)
+
+
+def iter_records(path, start=0):
+    """Yield (offset, timestamp, body) for records at or after start."""
+    segments = _segments(path)
+    for i, (base, segment_path) in enumerate(segments):
+        if i + 1 < len(segments) and segments[i + 1][0] <= start:
+            continue
+        with open(segment_path, 'rb') as f:
+            for offset, timestamp, body in _scan(f, base):
+                if offset >= start:
+                    yield offset, timestamp, body
+
+
+class Journal(object):
+
+    def __init__(self, directory, segment_bytes=64 * 1024 * 1024, fsync_every=32, fsync_interval=1.0):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def _open(self):
+        # called with the lock held; opens a new run directory after fork so
+        # that each worker gets its own files and flusher thread
+        self.path = os.path.join(self.directory, '{}-{}-{}'.format(
+            time.strftime('%Y%m%dT%H%M%S', time.gmtime()), os.getpid(), uuid.uuid4().hex[:8]))
+        os.makedirs(self.path)
+        self._pending = set()
+        self._unsynced = 0
+        self._checkpoint = self._synced_checkpoint = 0
+        self._failed = set()
+        self._file = None
+        self._new_segment(0)
+        self._pid = os.getpid()
+        self._closed = threading.Event()
+        threading.Thread(target=self._flusher, name='journal-flusher', daemon=True).start()
+        atexit.register(self.close)
+
+    def _new_segment(self, base):
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+        self._file = open(os.path.join(self.path, '%020d%s' % (base, SEGMENT_SUFFIX)), 'ab')
+        self._segment_base = self._end = base
+
+    def append(self, body):
+        """Append body (bytes) and return its offset for commit()."""
+        record = RECORD_HEADER.pack(len(body), zlib.crc32(body), time.time()) + body
+        with self._lock:
+            if self._pid != os.getpid():
+                self._open()
+            if self._end - self._segment_base >= self.segment_bytes:
+                self._new_segment(self._end)
+            offset = self._end
+            self._file.write(record)
+            self._file.flush()
+            self._end += len(record)
+            self._pending.add(offset)
+            self._unsynced += 1
+            if self._unsynced >= self.fsync_every:
+                self._sync()
+        return offset
+
+    def commit(self, offset):
+        """Mark the record at offset as handled."""
+        with self._lock:
+            if self._pid != os.getpid():
+                return
+            self._pending.discard(offset)
+            self._checkpoint = min(self._pending) if self._pending else self._end
+
+    def fail(self, offset):
+        """Mark the record at offset as failed; replay.py retries it."""
+        with self._lock:
+            if self._pid != os.getpid():
+                return
+            self._failed.add(offset)
+            write_failed(self.path, self._failed)
+            self._pending.discard(offset)
+            self._checkpoint = min(self._pending) if self._pending else self._end
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+        if self._checkpoint == self._synced_checkpoint:
+            return
+        self._synced_checkpoint = self._checkpoint
+        write_checkpoint(self.path, self._checkpoint)
+        remove_handled_segments(self.path, self._checkpoint, self._failed)
+
+    def _flusher(self):
+        closed = self._closed
+        while not closed.wait(self.fsync_interval):
+            with self._lock:
+                if self._closed is not closed:
+                    return
+                if not self._unsynced and self._checkpoint == self._synced_checkpoint:
+                    continue
+                try:
+                    self._sync()
+                except (OSError, ValueError):
+                    logger.exception('Failed to sync webhook journal')
+
+    def close(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                return
+            self._sync()
+            self._file.close()
+            self._closed.set()
+            self._pid = None
+            if not self._pending and not self._failed:
+                shutil.rmtree(self.path, ignore_errors=True)
@@ -0,0 +1,570 @@
+# -*- coding: utf-8 -*-
+
+#  Licensed under the Apache License, Version 2.0 (the "License"); you may
+#  not use this file except in compliance with the License. You may obtain
+#  a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#  License for the specific language governing permissions and limitations
+#  under the License.
+
+"""Key-value backends for state shared between processes and nodes.
+
+Keys are str, values are bytes, and every operation works on a batch so
+that a network backend answers it in a single round trip. Keys may instead
+hold a set of str members, which never expires:
+
+    memory://                   this process only
+    sqlite:///var/lib/bot.db    processes on one host (WAL, memory-mapped)
+    redis://host:6379/0         nodes behind a load balancer
+
+The network backend speaks the Redis protocol with pipelining and needs no
+client library. For local testing this module can serve that protocol
+itself from an in-memory store:
+
+    python kvstore.py serve --port 6380
+"""
+
+import os
+import socket
+import socketserver
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from argparse import ArgumentParser
+from urllib.parse import urlsplit
+
+
+# operations accepted by KVBackend.batch()
+BATCH_OPERATIONS = frozenset([
+    'get', 'set', 'add', 'delete', 'set_add', 'set_remove', 'set_members', 'set_count', 'set_contains',
+])
+
+
+class KVBackend(ABC):
+    """Batched key-value interface; ttl is in seconds, None for no expiry."""
+
+    @abstractmethod
+    def get_many(self, keys):
+        """Return {key: value} for the keys that exist."""
+
+    @abstractmethod
+    def set_many(self, items, ttl=None):
+        pass
+
+    @abstractmethod
+    def add_many(self, items, ttl=None):
+        """Set the keys that do not exist yet; return {key: True if set}."""
+
+    @abstractmethod
+    def delete_many(self, keys):
+        pass
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    def set(self, key, value, ttl=None):
+        self.set_many({key: value}, ttl)
+
+    def add(self, key, value, ttl=None):
+        return self.add_many({key: value}, ttl)[key]
+
+    def delete(self, key):
+        self.delete_many([key])
+
+    @abstractmethod
+    def set_add(self, key, members):
+        pass
+
+    @abstractmethod
+    def set_remove(self, key, members):
+        pass
+
+    @abstractmethod
+    def set_members(self, key):
+        """Return the members of the set at key as a set of str."""
+
+    @abstractmethod
+    def set_count(self, key):
+        pass
+
+    @abstractmethod
+    def set_contains(self, key, member):
+        pass
+
+    def batch(self, operations):
+        """Run [(name, *args)] operations in order and return their results.
+
+        Names are single-key methods of this class (BATCH_OPERATIONS); a
+        network backend sends the whole batch in one round trip.
+        """
+        results = []
+        for name, *args in operations:
+            if name not in BATCH_OPERATIONS:
+                raise ValueError('Unsupported batch operation: ' + name)
+            results.append(getattr(self, name)(*args))
+        return results
+
+
+# expired entries are swept once every SWEEP_EVERY writes
+SWEEP_EVERY = 1024
+
+
+class MemoryBackend(KVBackend):
+
+    def __init__(self):
+        self._data = {}
+        self._sets = {}
+        self._lock = threading.Lock()
+        self._writes = 0
+
+    def _sweep(self, now):
+        # called with the lock held
+        self._writes += 1
+        if self._writes % SWEEP_EVERY == 0:
+            for key in [key for key, (_, expires) in self._data.items() if expires is not None and expires <= now]:
+                del self._data[key]
+
+    def _live(self, key, now):
+        entry = self._data.get(key)
+        if entry is not None and entry[1] is not None and entry[1] <= now:
+            del self._data[key]
+            return None
+        return entry
+
+    def get_many(self, keys):
+        now = time.time()
+        with self._lock:
+            result = {}
+            for key in keys:
+                entry = self._live(key, now)
+                if entry is not None:
+                    result[key] = entry[0]
+            return result
+
+    def set_many(self, items, ttl=None):
+        now = time.time()
+        expires = now + ttl if ttl is not None else None
+        with self._lock:
+            self._sweep(now)
+            for key, value in items.items():
+                self._data[key] = (value, expires)
+
+    def add_many(self, items, ttl=None):
+        now = time.time()
+        expires = now + ttl if ttl is not None else None
+        with self._lock:
+            self._sweep(now)
+            result = {}
+            for key, value in items.items():
+                result[key] = self._live(key, now) is None
+                if result[key]:
+                    self._data[key] = (value, expires)
+            return result
+
+    def delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+                self._sets.pop(key, None)
+
+    def set_add(self, key, members):
+        with self._lock:
+            self._sets.setdefault(key, set()).update(members)
+
+    def set_remove(self, key, members):
+        with self._lock:
+            members_set = self._sets.get(key)
+            if members_set is not None:
+                members_set.difference_update(members)
+                if not members_set:
+                    del self._sets[key]
+
+    def set_members(self, key):
+        with self._lock:
+            return set(self._sets.get(key, ()))
+
+    def set_count(self, key):
+        return len(self._sets.get(key, ()))
+
+    def set_contains(self, key, member):
+        return member in self._sets.get(key, ())
+
+
+class SqliteBackend(KVBackend):
+
+    def __init__(self, path, mmap_size=256 * 1024 * 1024):
+        self.path = path
+        self.mmap_size = mmap_size
+        self._local = threading.local()
+        self._writes = 0
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._connection().execute(
+            'CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value BLOB NOT NULL, expires REAL)')
+        self._connection().execute(
+            'CREATE TABLE IF NOT EXISTS kv_set (key TEXT, member TEXT, PRIMARY KEY (key, member)) WITHOUT ROWID')
+
+    def _connection(self):
+        # one connection per thread and process
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            local.connection = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            local.connection.execute('PRAGMA journal_mode=WAL')
+            local.connection.execute('PRAGMA synchronous=NORMAL')
+            local.connection.execute('PRAGMA mmap_size=%d' % self.mmap_size)
+            local.pid = os.getpid()
+        return local.connection
+
+    def _sweep(self, connection, now):
+        self._writes += 1
+        if self._writes % SWEEP_EVERY == 0:
+            connection.execute('DELETE FROM kv WHERE expires <= ?', (now,))
+
+    def get_many(self, keys):
+        keys = list(keys)
+        if not keys:
+            return {}
+        rows = self._connection().execute(
+            'SELECT key, value FROM kv WHERE key IN (%s) AND (expires IS NULL OR expires > ?)'
+            % ','.join('?' * len(keys)), keys + [time.time()])
+        return {key: bytes(value) for key, value in rows}
+
+    def set_many(self, items, ttl=None):
+        now = time.time()
+        expires = now + ttl if ttl is not None else None
+        connection = self._connection()
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            self._sweep(connection, now)
+            connection.executemany('INSERT OR REPLACE INTO kv VALUES (?, ?, ?)',
+                                   [(key, value, expires) for key, value in items.items()])
+
+    def add_many(self, items, ttl=None):
+        now = time.time()
+        expires = now + ttl if ttl is not None else None
+        connection = self._connection()
+        result = {}
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            self._sweep(connection, now)
+            for key, value in items.items():
+                connection.execute('DELETE FROM kv WHERE key = ? AND expires <= ?', (key, now))
+                cursor = connection.execute('INSERT OR IGNORE INTO kv VALUES (?, ?, ?)', (key, value, expires))
+                result[key] = cursor.rowcount == 1
+        return result
+
+    def delete_many(self, keys):
+        connection = self._connection()
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            connection.executemany('DELETE FROM kv WHERE key = ?', [(key,) for key in keys])
+            connection.executemany('DELETE FROM kv_set WHERE key = ?', [(key,) for key in keys])
+
+    def set_add(self, key, members):
+        connection = self._connection()
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            connection.executemany('INSERT OR IGNORE INTO kv_set VALUES (?, ?)',
+                                   [(key, member) for member in members])
+
+    def set_remove(self, key, members):
+        connection = self._connection()
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            connection.executemany('DELETE FROM kv_set WHERE key = ? AND member = ?',
+                                   [(key, member) for member in members])
+
+    def set_members(self, key):
+        rows = self._connection().execute('SELECT member FROM kv_set WHERE key = ?', (key,))
+        return {member for member, in rows}
+
+    def set_count(self, key):
+        return self._connection().execute('SELECT COUNT(*) FROM kv_set WHERE key = ?', (key,)).fetchone()[0]
+
+    def set_contains(self, key, member):
+        return self._connection().execute(
+            'SELECT 1 FROM kv_set WHERE key = ? AND member = ?', (key, member)).fetchone() is not None
+
+
+class RespError(Exception):
+    pass
+
+
+def _encode_command(*args):
+    out = [b'*%d\r\n' % len(args)]
+    for arg in args:
+        if isinstance(arg, str):
+            arg = arg.encode('utf-8')
+        elif isinstance(arg, int):
+            arg = str(arg).encode('ascii')
+        out.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+    return b''.join(out)
+
+
+def _read_reply(f):
+    line = f.readline()
+    if not line:
+        raise ConnectionError('Connection closed by server')
+    kind, rest = line[:1], line[1:-2]
+    if kind == b'+':
+        return rest
+    elif kind == b'-':
+        return RespError(rest.decode('utf-8', 'replace'))
+    elif kind == b':':
+        return int(rest)
+    elif kind == b'$':
+        length = int(rest)
+        if length < 0:
+            return None
+        data = f.read(length + 2)
+        return data[:-2]
+    elif kind == b'*':
+        length = int(rest)
+        if length < 0:
+            return None
+        return [_read_reply(f) for _ in range(length)]
+    raise RespError('Unexpected reply: %r' % line)
+
+
+class RedisBackend(KVBackend):
+    """Redis protocol client; every batch is sent as one pipeline."""
+
+    def __init__(self, host='127.0.0.1', port=6379, db=0, password=None, timeout=2.0):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._local.sock = sock
+        self._local.file = sock.makefile('rb')
+        self._local.pid = os.getpid()
+        setup = []
+        if self.password:
+            setup.append(('AUTH', self.password))
+        if self.db:
+            setup.append(('SELECT', self.db))
+        if setup:
+            self._send(setup)
+
+    def _send(self, commands):
+        sock, f = self._local.sock, self._local.file
+        sock.sendall(b''.join(_encode_command(*command) for command in commands))
+        replies = [_read_reply(f) for _ in commands]
+        for reply in replies:
+            if isinstance(reply, RespError):
+                raise reply
+        return replies
+
+    def pipeline(self, commands):
+        """Send commands in one round trip and return their replies."""
+        if not commands:
+            return []
+        if getattr(self._local, 'pid', None) != os.getpid():
+            self._connect()
+        try:
+            return self._send(commands)
+        except OSError:
+            # not retried, as the commands may have been applied; the next
+            # call reconnects
+            self._local.sock.close()
+            self._local.pid = None
+            raise
+
+    @staticmethod
+    def _expiry(ttl):
+        return ('PX', int(ttl * 1000)) if ttl is not None else ()
+
+    def get_many(self, keys):
+        keys = list(keys)
+        if not keys:
+            return {}
+        values = self.pipeline([('MGET',) + tuple(keys)])[0]
+        return {key: value for key, value in zip(keys, values) if value is not None}
+
+    def set_many(self, items, ttl=None):
+        self.pipeline([('SET', key, value) + self._expiry(ttl) for key, value in items.items()])
+
+    def add_many(self, items, ttl=None):
+        keys = list(items)
+        replies = self.pipeline([('SET', key, items[key], 'NX') + self._expiry(ttl) for key in keys])
+        return {key: reply is not None for key, reply in zip(keys, replies)}
+
+    def delete_many(self, keys):
+        keys = list(keys)
+        if keys:
+            self.pipeline([('DEL',) + tuple(keys)])
+
+    def set_add(self, key, members):
+        members = tuple(members)
+        if members:
+            self.pipeline([('SADD', key) + members])
+
+    def set_remove(self, key, members):
+        members = tuple(members)
+        if members:
+            self.pipeline([('SREM', key) + members])
+
+    def set_members(self, key):
+        return {member.decode('utf-8') for member in self.pipeline([('SMEMBERS', key)])[0]}
+
+    def set_count(self, key):
+        return self.pipeline([('SCARD', key)])[0]
+
+    def set_contains(self, key, member):
+        return self.pipeline([('SISMEMBER', key, member)])[0] == 1
+
+    def _command(self, name, key, *args):
+        """Return (command or None, reply converter) for a batch operation."""
+        if name == 'get':
+            return ('GET', key), None
+        elif name == 'set':
+            return ('SET', key, args[0]) + self._expiry(args[1] if len(args) > 1 else None), lambda reply: None
+        elif name == 'add':
+            return (('SET', key, args[0], 'NX') + self._expiry(args[1] if len(args) > 1 else None),
+                    lambda reply: reply is not None)
+        elif name == 'delete':
+            return ('DEL', key), lambda reply: None
+        elif name in ('set_add', 'set_remove'):
+            members = tuple(args[0])
+            command = ('SADD' if name == 'set_add' else 'SREM', key) + members
+            return (command if members else None), lambda reply: None
+        elif name == 'set_members':
+            return ('SMEMBERS', key), lambda reply: {member.decode('utf-8') for member in reply}
+        elif name == 'set_count':
+            return ('SCARD', key), None
+        elif name == 'set_contains':
+            return ('SISMEMBER', key, args[0]), lambda reply: reply == 1
+        raise ValueError('Unsupported batch operation: ' + name)
+
+    def batch(self, operations):
+        commands = [self._command(*operation) for operation in operations]
+        replies = iter(self.pipeline([command for command, _ in commands if command is not None]))
+        results = []
+        for command, convert in commands:
+            reply = next(replies) if command is not None else None
+            results.append(convert(reply) if convert is not None else reply)
+        return results
+
+
+def open_backend(url):
+    parts = urlsplit(url)
+    if parts.scheme == 'memory':
+        return MemoryBackend()
+    elif parts.scheme == 'sqlite':
+        return SqliteBackend(parts.path)
+    elif parts.scheme == 'redis':
+        return RedisBackend(parts.hostname or '127.0.0.1', parts.port or 6379,
+                            int(parts.path.strip('/') or 0), parts.password)
+    raise ValueError('Unsupported key-value backend: ' + url)
+
+
+class _RespHandler(socketserver.StreamRequestHandler):
+    """Stand-in Redis server: PING, GET, MGET, SET [NX] [EX|PX], DEL, SADD, SREM,
+    SMEMBERS, SCARD, SISMEMBER, SELECT, AUTH."""
+
+    def _write(self, reply):
+        if reply is None:
+            self.wfile.write(b'$-1\r\n')
+        elif isinstance(reply, RespError):
+            self.wfile.write(b'-ERR %s\r\n' % str(reply).encode('utf-8'))
+        elif isinstance(reply, int):
+            self.wfile.write(b':%d\r\n' % reply)
+        elif isinstance(reply, list):
+            self.wfile.write(b'*%d\r\n' % len(reply))
+            for item in reply:
+                self._write(item)
+        elif reply == b'OK' or reply == b'PONG':
+            self.wfile.write(b'+%s\r\n' % reply)
+        else:
+            self.wfile.write(b'$%d\r\n%s\r\n' % (len(reply), reply))
+
+    def _execute(self, args):
+        store = self.server.store
+        command = args[0].upper()
+        keys = [arg.decode('utf-8') for arg in args[1:]]
+        if command == b'PING':
+            return b'PONG'
+        elif command in (b'SELECT', b'AUTH'):
+            return b'OK'
+        elif command == b'GET':
+            return store.get(keys[0])
+        elif command == b'MGET':
+            found = store.get_many(keys)
+            return [found.get(key) for key in keys]
+        elif command == b'DEL':
+            found = [key for key in keys if key in store.get_many(keys) or store.set_count(key)]
+            store.delete_many(keys)
+            return len(found)
+        elif command == b'SADD':
+            added = set(keys[1:]) - store.set_members(keys[0])
+            store.set_add(keys[0], keys[1:])
+            return len(added)
+        elif command == b'SREM':
+            removed = set(keys[1:]) & store.set_members(keys[0])
+            store.set_remove(keys[0], keys[1:])
+            return len(removed)
+        elif command == b'SMEMBERS':
+            return [member.encode('utf-8') for member in store.set_members(keys[0])]
+        elif command == b'SCARD':
+            return store.set_count(keys[0])
+        elif command == b'SISMEMBER':
+            return int(store.set_contains(keys[0], keys[1]))
+        elif command == b'SET':
+            key, value, options = keys[0], args[2], [arg.upper() for arg in args[3:]]
+            ttl = None
+            if b'EX' in options:
+                ttl = float(options[options.index(b'EX') + 1])
+            elif b'PX' in options:
+                ttl = float(options[options.index(b'PX') + 1]) / 1000
+            if b'NX' in options:
+                return b'OK' if store.add(key, value, ttl) else None
+            store.set(key, value, ttl)
+            return b'OK'
+        return RespError('unknown command ' + command.decode('utf-8', 'replace'))
+
+    def handle(self):
+        while True:
+            try:
+                args = _read_reply(self.rfile)
+            except (ConnectionError, OSError):
+                return
+            if not isinstance(args, list) or not args:
+                return
+            try:
+                self._write(self._execute(args))
+            except (IndexError, ValueError) as e:
+                self._write(RespError(str(e)))
+            self.wfile.flush()
+
+
+class RespServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, store=None):
+        super().__init__(address, _RespHandler)
+        self.store = store if store is not None else MemoryBackend()
+
+
+if __name__ == '__main__':
+    arg_parser = ArgumentParser(
+        usage='Usage: python ' + __file__ + ' serve [--host <host>] [--port <port>]'
+    )
+    arg_parser.add_argument('command', choices=['serve'])
+    arg_parser.add_argument('--host', default='127.0.0.1')
+    arg_parser.add_argument('-p', '--port', type=int, default=6380)
+    options = arg_parser.parse_args()
+
+    server = RespServer((options.host, options.port))
+    print('Serving the Redis protocol on {}:{}'.format(options.host, options.port))
+    server.serve_forever()
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+
+#  Licensed under the Apache License, Version 2.0 (the "License"); you may
+#  not use this file except in compliance with the License. You may obtain
+#  a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#  License for the specific language governing permissions and limitations
+#  under the License.
+
+"""Member ID index of the groups and rooms the bot is in.
+
+A chat's member set is filled once by a background walk over the
+paginated members API, and kept current from member joined/left events.
+The sets live in a key-value backend (see kvstore.py), so every worker
+and node answers from the same index:
+
+    members:<chat id>         set of member user IDs
+    members:left:<chat id>    users who left since the last walk ended
+    members:state:<chat id>   b'loading' (expires), b'complete' or
+                              b'unavailable' (expires)
+
+Only the worker that claims the 'loading' state walks a chat. Users who
+leave are remembered until the walk ends so that a later page cannot add
+them back. If the walking worker dies, the claim expires after
+LOAD_TIMEOUT seconds and the next load() starts over. The members API
+answers 403 for accounts that are not verified or premium; the chat is
+then marked unavailable for UNAVAILABLE_TTL seconds instead of being
+walked again on every load(). Queries never call
+the API, and every event or query costs one batch (see KVBackend.batch).
+Updates from events are logged and dropped if the backend fails, so that
+webhooks keep working; queries raise the backend's error.
+"""
+
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from linebot.v3.messaging import (
+    ApiClient,
+    MessagingApi,
+    ApiException
+)
+from linebot.v3.webhooks import (
+    GroupSource,
+    RoomSource
+)
+
+from kvstore import MemoryBackend
+
+
+LOAD_TIMEOUT = 10 * 60
+LOADING = b'loading'
+COMPLETE = b'complete'
+UNAVAILABLE = b'unavailable'
+UNAVAILABLE_TTL = 6 * 60 * 60
+
+logger = logging.getLogger(__name__)
+
+
+def chat_id_of(source):
+    if isinstance(source, GroupSource):
+        return source.group_id
+    elif isinstance(source, RoomSource):
+        return source.room_id
+    return None
+
+
+def _keys(chat_id):
+    return 'members:' + chat_id, 'members:left:' + chat_id, 'members:state:' + chat_id
+
+
+class MembershipIndex(object):
+
+    def __init__(self, configuration, store=None, max_workers=2):
+        self.configuration = configuration
+        self.store = store if store is not None else MemoryBackend()
+        self.max_workers = max_workers
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def load(self, source):
+        """Start filling the index for the group or room of source.
+
+        Return the state of the chat (LOADING, COMPLETE or UNAVAILABLE), or
+        None if it is unknown.
+        """
+        chat_id = chat_id_of(source)
+        if chat_id is None:
+            return None
+        state_key = _keys(chat_id)[2]
+        try:
+            claimed, state = self.store.batch([('add', state_key, LOADING, LOAD_TIMEOUT), ('get', state_key)])
+        except Exception:
+            logger.exception("Failed to start loading members of %s", chat_id)
+            return None
+        if not claimed:
+            return state
+        with self._lock:
+            if self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                    thread_name_prefix='membership')
+                self._pid = os.getpid()
+        self._executor.submit(self._fetch, source, chat_id)
+        return LOADING
+
+    def _fetch(self, source, chat_id):
+        members_key, left_key, state_key = _keys(chat_id)
+        start = None
+        complete = unavailable = False
+        try:
+            with ApiClient(self.configuration) as api_client:
+                line_bot_api = MessagingApi(api_client)
+                while True:
+                    if isinstance(source, GroupSource):
+                        response = line_bot_api.get_group_members_ids(chat_id, start=start)
+                    else:
+                        response = line_bot_api.get_room_members_ids(chat_id, start=start)
+                    # remove() records a leaver before removing it, so
+                    # reading the leavers after adding the page is enough
+                    _, left, state = self.store.batch([
+                        ('set_add', members_key, response.member_ids),
+                        ('set_members', left_key),
+                        ('get', state_key),
+                    ])
+                    if state != LOADING:
+                        # the bot left the chat during the walk
+                        self.store.delete(members_key)
+                        return
+                    self.store.set_remove(members_key, left & set(response.member_ids))
+                    if not response.next:
+                        break
+                    start = response.next
+            complete = True
+        except ApiException as e:
+            logger.warning("Failed to fetch members of %s: %s", chat_id, e.body)
+            unavailable = e.status == 403
+        except Exception:
+            # network and backend errors; the next load() retries the walk
+            logger.exception("Failed to fetch members of %s", chat_id)
+        finally:
+            try:
+                if complete:
+                    self.store.set(state_key, COMPLETE)
+                elif unavailable:
+                    self.store.delete(members_key)
+                    self.store.set(state_key, UNAVAILABLE, ttl=UNAVAILABLE_TTL)
+                elif self.store.get(state_key) == LOADING:
+                    self.store.delete(state_key)
+                self.store.delete(left_key)
+            except Exception:
+                logger.exception("Failed to update the member index state of %s", chat_id)
+
+    def _update(self, chat_id, operations):
+        try:
+            self.store.batch(operations)
+        except Exception:
+            logger.exception("Failed to update the member index of %s", chat_id)
+
+    def add(self, source, user_ids):
+        chat_id = chat_id_of(source)
+        if chat_id is None:
+            return
+        members_key, left_key, _ = _keys(chat_id)
+        self._update(chat_id, [('set_add', members_key, user_ids), ('set_remove', left_key, user_ids)])
+
+    def remove(self, source, user_ids):
+        chat_id = chat_id_of(source)
+        if chat_id is None:
+            return
+        members_key, left_key, _ = _keys(chat_id)
+        self._update(chat_id, [('set_add', left_key, user_ids), ('set_remove', members_key, user_ids)])
+
+    def drop(self, source):
+        chat_id = chat_id_of(source)
+        if chat_id is not None:
+            self._update(chat_id, [('delete', key) for key in _keys(chat_id)])
+
+    def is_complete(self, source):
+        chat_id = chat_id_of(source)
+        return chat_id is not None and self.store.get(_keys(chat_id)[2]) == COMPLETE
+
+    def is_member(self, source, user_id):
+        """Return True/False, or None while the chat is not fully loaded."""
+        chat_id = chat_id_of(source)
+        if chat_id is None:
+            return None
+        members_key, _, state_key = _keys(chat_id)
+        contains, state = self.store.batch([('set_contains', members_key, user_id), ('get', state_key)])
+        if contains:
+            return True
+        return False if state == COMPLETE else None
+
+    def count(self, source):
+        """Return the number of members, or None while not fully loaded."""
+        chat_id = chat_id_of(source)
+        if chat_id is None:
+            return None
+        members_key, _, state_key = _keys(chat_id)
+        count, state = self.store.batch([('set_count', members_key), ('get', state_key)])
+        return count if state == COMPLETE else None
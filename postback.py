@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+#  Licensed under the Apache License, Version 2.0 (the "License"); you may
+#  not use this file except in compliance with the License. You may obtain
+#  a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#  License for the specific language governing permissions and limitations
+#  under the License.
+
+"""Postback data encoding and routing.
+
+Postback data has the form ``action`` or ``action?key=value&...``, so plain
+strings such as 'ping' keep working. When that form does not fit into
+LINE's 300 character limit it is zlib-compressed and sent as
+``~<urlsafe base64>``.
+"""
+
+import base64
+import binascii
+import zlib
+from collections import namedtuple
+from urllib.parse import parse_qsl, urlencode
+
+
+MAX_DATA_LENGTH = 300
+COMPACT_PREFIX = '~'
+
+# params: values from the data string; picker: event.postback.params
+# (date/time picker results) or None
+Postback = namedtuple('Postback', ['action', 'params', 'picker'])
+
+
+def encode(action, **params):
+    data = action
+    if params:
+        data += '?' + urlencode(sorted(params.items()))
+    if len(data) <= MAX_DATA_LENGTH and not data.startswith(COMPACT_PREFIX):
+        return data
+
+    compact = COMPACT_PREFIX + base64.urlsafe_b64encode(
+        zlib.compress(data.encode('utf-8'), 9)).decode('ascii').rstrip('=')
+    if len(compact) > MAX_DATA_LENGTH:
+        raise ValueError('Postback data for {} is too long: {} characters'.format(action, len(compact)))
+    return compact
+
+
+def decode(data, picker=None):
+    if data.startswith(COMPACT_PREFIX):
+        payload = data[len(COMPACT_PREFIX):]
+        try:
+            data = zlib.decompress(
+                base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4))).decode('utf-8')
+        except (binascii.Error, zlib.error, UnicodeDecodeError) as e:
+            raise ValueError('Malformed compact postback data: {}'.format(e))
+    action, _, query = data.partition('?')
+    return Postback(action, dict(parse_qsl(query, keep_blank_values=True)), picker)
+
+
+class PostbackRouter(object):
+
+    def __init__(self):
+        self._routes = {}
+
+    def add(self, action, **types):
+        """Register a handler for action.
+
+        Keyword arguments map parameter names to converters (e.g. page=int)
+        applied before the handler is called.
+        """
+        def decorator(func):
+            self._routes[action] = (func, types)
+            return func
+
+        return decorator
+
+    def dispatch(self, event, *args):
+        """Call the handler registered for event's postback data.
+
+        The handler is called as func(event, postback, *args). Returns False
+        when the data is malformed or no handler is registered.
+        """
+        try:
+            postback = decode(event.postback.data, event.postback.params)
+        except ValueError:
+            return False
+
+        route = self._routes.get(postback.action)
+        if route is None:
+            return False
+
+        func, types = route
+        if types:
+            params = dict(postback.params)
+            try:
+                for key, convert in types.items():
+                    if key in params:
+                        params[key] = convert(params[key])
+            except ValueError:
+                return False
+            postback = postback._replace(params=params)
+
+        func(event, postback, *args)
+        return True
@@ -0,0 +1,401 @@
+# -*- coding: utf-8 -*-
+
+#  Licensed under the Apache License, Version 2.0 (the "License"); you may
+#  not use this file except in compliance with the License. You may obtain
+#  a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#  License for the specific language governing permissions and limitations
+#  under the License.
+
+"""Runtime memory and CPU profiling of the workers through admin routes.
+
+Nothing here is imported into the request path unless install() is
+called. Once installed, each route needs the X-Profiling-Token header.
+Without a `store` the routes act on the worker process that serves them.
+With a key-value store (see kvstore.py) start/stop record the wanted state
+there, every worker polls it each POLL_INTERVAL seconds and publishes its
+counters, and the read routes merge the counters of all workers (the
+tracemalloc snapshot is a section per worker):
+
+    POST /admin/profiling/tracemalloc/start?frames=10
+    GET  /admin/profiling/tracemalloc/snapshot?limit=25   diff to previous snapshot
+    POST /admin/profiling/tracemalloc/stop
+    POST /admin/profiling/handlers/start                  per-handler counters
+    GET  /admin/profiling/handlers
+    POST /admin/profiling/handlers/stop
+    POST /admin/profiling/cpu/start?interval=0.005        sampling profiler
+    GET  /admin/profiling/cpu                             collapsed stacks
+    POST /admin/profiling/cpu/stop
+
+Per-handler allocation counts are deltas of the process-wide block count
+(and of traced bytes while tracemalloc runs), so they include allocations
+of concurrent requests.
+
+The CPU profiler only records a thread's stack if the thread was on a CPU
+for at least BUSY_FRACTION of the time since the previous sample, judged
+from the scheduler's per-thread CPU time in /proc, so idle pool threads
+and sleeping background threads do not show up. Where /proc is not available every thread is sampled, which gives
+wall-clock stacks instead. The interval is at least MIN_SAMPLE_INTERVAL.
+"""
+
+import hmac
+import inspect
+import json
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+from collections import Counter
+
+from flask import Blueprint, Response, abort, jsonify, request
+
+
+HANDLER_FIELDS = ('calls', 'seconds', 'blocks', 'traced_bytes')
+MIN_SAMPLE_INTERVAL = 0.001
+BUSY_FRACTION = 0.25
+POLL_INTERVAL = 1.0
+REPORT_TTL = 60 * 60
+
+STATE_KEY = 'profiling:state'
+SNAPSHOT_REQUEST_KEY = 'profiling:snapshot'
+WORKERS_KEY = 'profiling:workers'
+REPORT_PREFIX = 'profiling:report:'
+SNAPSHOT_PREFIX = 'profiling:snapshot:'
+
+logger = logging.getLogger(__name__)
+
+
+class _State(object):
+
+    def __init__(self):
+        self.handlers_on = False
+        self.handler_stats = {}
+        self.snapshot = None
+        self.sampler = None
+        self.samples = Counter()
+        self.desired = {}
+        self.applied = {}
+        self.lock = threading.Lock()
+
+
+_state = _State()
+
+
+def _instrument(name, func):
+    spec = inspect.getfullargspec(func)
+    stats = _state.handler_stats
+
+    def call(*args):
+        if not _state.handlers_on:
+            return func(*args)
+        tracing = tracemalloc.is_tracing()
+        blocks = sys.getallocatedblocks()
+        traced = tracemalloc.get_traced_memory()[0] if tracing else 0
+        started = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            elapsed = time.perf_counter() - started
+            blocks = sys.getallocatedblocks() - blocks
+            traced = tracemalloc.get_traced_memory()[0] - traced if tracing else 0
+            with _state.lock:
+                entry = stats.setdefault(name, [0, 0.0, 0, 0])
+                entry[0] += 1
+                entry[1] += elapsed
+                entry[2] += blocks
+                entry[3] += traced
+
+    # WebhookHandler picks the call signature from the argument count
+    if spec.varargs is not None or len(spec.args) == 2:
+        def wrapper(event, destination):
+            return call(event, destination)
+    elif len(spec.args) == 1:
+        def wrapper(event):
+            return call(event)
+    else:
+        def wrapper():
+            return call()
+    wrapper.__name__ = func.__name__
+    wrapper.__wrapped__ = func
+    return wrapper
+
+
+_HAS_SCHEDSTAT = os.path.exists('/proc/self/task/%d/schedstat' % threading.get_native_id())
+
+
+def _cpu_ns(native_id):
+    # nanoseconds the thread has spent on a CPU, or 0 if unknown (e.g. a
+    # stale native id of the main thread after fork)
+    try:
+        with open('/proc/self/task/%d/schedstat' % native_id, 'rb') as f:
+            return int(f.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def _sample(interval, stop):
+    own = threading.get_ident()
+    cpu = {}
+    sampled = time.perf_counter_ns()
+    while not stop.wait(interval):
+        # a thread counts as busy if it was on a CPU for a good part of the
+        # time since the previous sample, not just woken up briefly
+        now = time.perf_counter_ns()
+        busy_ns, sampled = (now - sampled) * BUSY_FRACTION, now
+        native_ids = {thread.ident: thread.native_id for thread in threading.enumerate()}
+        frames = sys._current_frames()
+        previous, cpu = cpu, {}
+        for thread_id, frame in frames.items():
+            if thread_id == own:
+                continue
+            if _HAS_SCHEDSTAT:
+                used = cpu[thread_id] = _cpu_ns(native_ids.get(thread_id, 0))
+                if used - previous.get(thread_id, used) < busy_ns:
+                    continue
+            stack = []
+            while frame is not None and len(stack) < 64:
+                code = frame.f_code
+                stack.append('{}:{}'.format(code.co_filename.rsplit('/', 1)[-1], code.co_name))
+                frame = frame.f_back
+            with _state.lock:
+                _state.samples[';'.join(reversed(stack))] += 1
+
+
+def _apply(desired):
+    """Bring the profilers of this worker to the desired state.
+
+    desired has 'tracemalloc' (frames), 'handlers' (start time) and 'cpu'
+    ([interval, start time]), each None when off; a new start time resets
+    the counters.
+    """
+    applied = _state.applied
+    frames = desired.get('tracemalloc')
+    if frames != applied.get('tracemalloc'):
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        _state.snapshot = None
+        if frames:
+            tracemalloc.start(frames)
+            _state.snapshot = tracemalloc.take_snapshot()
+
+    handlers = desired.get('handlers')
+    if handlers != applied.get('handlers'):
+        if handlers:
+            with _state.lock:
+                _state.handler_stats.clear()
+        _state.handlers_on = bool(handlers)
+
+    cpu = desired.get('cpu')
+    if cpu != applied.get('cpu'):
+        with _state.lock:
+            if _state.sampler is not None:
+                _state.sampler.set()
+                _state.sampler = None
+            if cpu:
+                _state.samples.clear()
+                _state.sampler = threading.Event()
+                threading.Thread(target=_sample, name='profiling-sampler', daemon=True,
+                                 args=(max(cpu[0], MIN_SAMPLE_INTERVAL), _state.sampler)).start()
+    _state.applied = dict(desired)
+
+
+def _snapshot_lines(limit):
+    snapshot = tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+    ])
+    if _state.snapshot is not None:
+        stats = snapshot.compare_to(_state.snapshot, 'lineno')
+    else:
+        stats = snapshot.statistics('lineno')
+    _state.snapshot = snapshot
+    current, peak = tracemalloc.get_traced_memory()
+    lines = ['traced: {} bytes, peak: {} bytes'.format(current, peak)]
+    lines.extend(str(stat) for stat in stats[:limit])
+    return lines
+
+
+def _report():
+    with _state.lock:
+        return {'handlers': {name: list(entry) for name, entry in _state.handler_stats.items()},
+                'cpu': dict(_state.samples)}
+
+
+def _merge(reports):
+    handlers = {}
+    samples = Counter()
+    for report in reports:
+        for name, entry in report['handlers'].items():
+            total = handlers.setdefault(name, [0, 0.0, 0, 0])
+            for i, value in enumerate(entry):
+                total[i] += value
+        samples.update(report['cpu'])
+    return handlers, samples
+
+
+class _Sync(object):
+    """Keeps the profilers of all workers in step through a key-value store."""
+
+    def __init__(self, store):
+        self.store = store
+        self.worker_id = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def ensure_started(self):
+        # the poller runs in each worker, never in the gunicorn master
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self.worker_id = '{}:{}'.format(socket.gethostname(), os.getpid())
+            threading.Thread(target=self._run, name='profiling-sync', daemon=True).start()
+
+    def update(self, **changes):
+        raw = self.store.get(STATE_KEY)
+        desired = json.loads(raw.decode('utf-8')) if raw else {}
+        desired.update(changes)
+        self.store.set(STATE_KEY, json.dumps(desired).encode('utf-8'))
+        _apply(desired)
+
+    def _run(self):
+        was_on = False
+        served = None
+        while True:
+            time.sleep(POLL_INTERVAL)
+            try:
+                raw, snapshot_request = self.store.batch([('get', STATE_KEY), ('get', SNAPSHOT_REQUEST_KEY)])
+                desired = json.loads(raw.decode('utf-8')) if raw else {}
+                _apply(desired)
+
+                operations = []
+                on = bool(desired.get('handlers') or desired.get('cpu'))
+                if on or was_on:
+                    # one last report after stopping keeps the final counters
+                    operations.append(('set', REPORT_PREFIX + self.worker_id,
+                                       json.dumps(_report()).encode('utf-8'), REPORT_TTL))
+                was_on = on
+                if snapshot_request is not None and snapshot_request != served and tracemalloc.is_tracing():
+                    served = snapshot_request
+                    snapshot_request = json.loads(snapshot_request.decode('utf-8'))
+                    operations.append(('set', SNAPSHOT_PREFIX + self.worker_id + ':' + snapshot_request['id'],
+                                       '\n'.join(_snapshot_lines(snapshot_request['limit'])).encode('utf-8'),
+                                       REPORT_TTL))
+                if operations:
+                    operations.append(('set_add', WORKERS_KEY, [self.worker_id]))
+                    self.store.batch(operations)
+            except Exception:
+                logger.exception('Failed to sync profiling state')
+
+    def reports(self):
+        workers = self.store.set_members(WORKERS_KEY)
+        found = self.store.get_many([REPORT_PREFIX + worker for worker in workers])
+        return [json.loads(value.decode('utf-8')) for value in found.values()]
+
+    def snapshots(self, limit):
+        """Ask every tracing worker for a snapshot; return {worker: text}."""
+        request_id = uuid.uuid4().hex
+        self.store.set(SNAPSHOT_REQUEST_KEY, json.dumps({'id': request_id, 'limit': limit}).encode('utf-8'),
+                       REPORT_TTL)
+        time.sleep(2 * POLL_INTERVAL + 0.5)
+        workers = sorted(self.store.set_members(WORKERS_KEY))
+        found = self.store.get_many([SNAPSHOT_PREFIX + worker + ':' + request_id for worker in workers])
+        return {worker: found[SNAPSHOT_PREFIX + worker + ':' + request_id].decode('utf-8')
+                for worker in workers if SNAPSHOT_PREFIX + worker + ':' + request_id in found}
+
+
+def _require_token(token):
+    given = request.headers.get('X-Profiling-Token', '')
+    if not hmac.compare_digest(given.encode('utf-8'), token.encode('utf-8')):
+        abort(404)
+
+
+def install(app, handler, token, store=None):
+    """Instrument handler's registered functions and add the admin routes."""
+    for key, func in list(handler._handlers.items()):
+        handler._handlers[key] = _instrument(key, func)
+    if handler._default is not None:
+        handler._default = _instrument('default', handler._default)
+
+    sync = _Sync(store) if store is not None else None
+    if sync is not None:
+        app.before_request(sync.ensure_started)
+
+    def change(**changes):
+        if sync is not None:
+            sync.update(**changes)
+        else:
+            _state.desired.update(changes)
+            _apply(_state.desired)
+
+    def merged():
+        if sync is not None:
+            return _merge(sync.reports())
+        return _merge([_report()])
+
+    blueprint = Blueprint('profiling', __name__, url_prefix='/admin/profiling')
+    blueprint.before_request(lambda: _require_token(token))
+
+    @blueprint.route('/tracemalloc/start', methods=['POST'])
+    def tracemalloc_start():
+        change(tracemalloc=request.args.get('frames', 1, type=int))
+        return 'OK'
+
+    @blueprint.route('/tracemalloc/stop', methods=['POST'])
+    def tracemalloc_stop():
+        change(tracemalloc=None)
+        return 'OK'
+
+    @blueprint.route('/tracemalloc/snapshot')
+    def tracemalloc_snapshot():
+        limit = request.args.get('limit', 25, type=int)
+        if sync is None:
+            if not tracemalloc.is_tracing():
+                abort(409)
+            return Response('\n'.join(_snapshot_lines(limit)) + '\n', mimetype='text/plain')
+        sections = sync.snapshots(limit)
+        if not sections:
+            abort(409)
+        return Response(''.join('== {} ==\n{}\n'.format(worker, text) for worker, text in sections.items()),
+                        mimetype='text/plain')
+
+    @blueprint.route('/handlers/start', methods=['POST'])
+    def handlers_start():
+        change(handlers=time.time())
+        return 'OK'
+
+    @blueprint.route('/handlers/stop', methods=['POST'])
+    def handlers_stop():
+        change(handlers=None)
+        return 'OK'
+
+    @blueprint.route('/handlers')
+    def handlers_stats():
+        handlers, _ = merged()
+        return jsonify({name: dict(zip(HANDLER_FIELDS, entry)) for name, entry in handlers.items()})
+
+    @blueprint.route('/cpu/start', methods=['POST'])
+    def cpu_start():
+        change(cpu=[max(request.args.get('interval', 0.005, type=float), MIN_SAMPLE_INTERVAL), time.time()])
+        return 'OK'
+
+    @blueprint.route('/cpu/stop', methods=['POST'])
+    def cpu_stop():
+        change(cpu=None)
+        return 'OK'
+
+    @blueprint.route('/cpu')
+    def cpu_samples():
+        _, samples = merged()
+        lines = ['{} {}'.format(stack, count) for stack, count in samples.most_common()]
+        return Response('\n'.join(lines) + '\n', mimetype='text/plain')
+
+    app.register_blueprint(blueprint)
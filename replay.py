@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+
+#  Licensed under the Apache License, Version 2.0 (the "License"); you may
+#  not use this file except in compliance with the License. You may obtain
+#  a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#  License for the specific language governing permissions and limitations
+#  under the License.
+
+"""Re-feed journaled webhook bodies through app.py's registered handlers.
+
+By default only the records after each journal's checkpoint and the
+records whose handling failed are replayed (crash recovery), skipping the
+journals of processes that are still running. Every LINE API call is
+answered locally by a mock, so the run can be used to reproduce production
+load offline:
+
+    python replay.py /var/lib/linebot/journal --all --speed 10 --profile replay.prof
+
+With --live (and without --all) the recovery is recorded: each journal's
+checkpoint and failed records are updated after every record, and a
+journal is removed once all of it has been handled, so running it again
+does not resend anything.
+
+LINE_CHANNEL_SECRET and LINE_CHANNEL_ACCESS_TOKEN must be set as for app.py.
+"""
+
+import base64
+import cProfile
+import hashlib
+import heapq
+import hmac
+import json
+import logging
+import shutil
+import time
+from argparse import ArgumentParser
+from urllib.parse import urlsplit
+
+import urllib3
+
+from journal import (
+    RECORD_HEADER,
+    is_running,
+    iter_records,
+    journal_dirs,
+    read_checkpoint,
+    read_failed,
+    remove_handled_segments,
+    write_checkpoint,
+    write_failed
+)
+
+
+# canned bodies for API calls whose responses the handlers read; anything
+# else gets an empty JSON object
+MOCK_RESPONSES = [
+    ('/v2/bot/message/reply', {'sentMessages': [{'id': '0'}]}),
+    ('/v2/bot/message/push', {'sentMessages': [{'id': '0'}]}),
+    ('/v2/bot/profile/', {'displayName': 'replay', 'userId': 'U' + '0' * 32}),
+    ('/v2/bot/message/quota/consumption', {'totalUsage': 0}),
+    ('/v2/bot/message/quota', {'type': 'none'}),
+    ('/v2/bot/message/delivery/broadcast', {'status': 'ready', 'success': 0}),
+    ('/members/ids', {'memberIds': []}),
+    ('/linkToken', {'linkToken': 'replay'}),
+    ('/v2/bot/insight/demographic', {'available': False}),
+    ('/v2/bot/insight/', {'status': 'ready'}),
+]
+
+
+def mock_urlopen(self, method, url, *args, **kwargs):
+    path = urlsplit(url).path
+    data = {}
+    for fragment, response in MOCK_RESPONSES:
+        if fragment in path:
+            data = response
+            break
+    return urllib3.HTTPResponse(
+        body=json.dumps(data).encode('utf-8'),
+        status=200,
+        headers={'Content-Type': 'application/json', 'x-line-request-id': 'replay'},
+        preload_content=True
+    )
+
+
+class _Run(object):
+    """Replay progress of one journal directory."""
+
+    def __init__(self, path, replay_all):
+        self.path = path
+        self.checkpoint = 0 if replay_all else read_checkpoint(path)
+        self.failed = set() if replay_all else read_failed(path)
+
+    def records(self):
+        for offset, timestamp, body in iter_records(self.path, min(self.failed | {self.checkpoint})):
+            if offset >= self.checkpoint or offset in self.failed:
+                yield timestamp, self.path, offset, body
+
+    def done(self, offset, body, ok):
+        if ok and offset in self.failed:
+            self.failed.discard(offset)
+            write_failed(self.path, self.failed)
+        elif not ok and offset not in self.failed:
+            self.failed.add(offset)
+            write_failed(self.path, self.failed)
+        if offset >= self.checkpoint:
+            self.checkpoint = offset + RECORD_HEADER.size + len(body)
+            write_checkpoint(self.path, self.checkpoint)
+
+    def finish(self):
+        if self.failed:
+            remove_handled_segments(self.path, self.checkpoint, self.failed)
+        else:
+            shutil.rmtree(self.path, ignore_errors=True)
+
+
+def replay(directory, replay_all=False, speed=0.0, base_url='https://localhost/', record_progress=False):
+    import app
+
+    # journaled events were already seen by the live deduplicator
+    app.handler.parser = app.event_deduplicator.parser
+
+    runs = {}
+    for path in journal_dirs(directory):
+        if not replay_all and is_running(path):
+            app.app.logger.info('Skipping %s, its process is still running', path)
+            continue
+        runs[path] = _Run(path, replay_all)
+    streams = [run.records() for run in runs.values()]
+    record_progress = record_progress and not replay_all
+
+    secret = app.channel_secret.encode('utf-8')
+    handled = failed = 0
+    first_timestamp = None
+    started = time.monotonic()
+    for timestamp, path, offset, body in heapq.merge(*streams):
+        if speed > 0:
+            if first_timestamp is None:
+                first_timestamp = timestamp
+            delay = (timestamp - first_timestamp) / speed - (time.monotonic() - started)
+            if delay > 0:
+                time.sleep(delay)
+
+        signature = base64.b64encode(hmac.new(secret, body, hashlib.sha256).digest()).decode('ascii')
+        with app.app.test_request_context('/callback', method='POST', base_url=base_url):
+            try:
+                app.handler.handle(body.decode('utf-8'), signature)
+                handled += 1
+                ok = True
+            except Exception:
+                app.app.logger.exception('Failed to replay %s at offset %d', path, offset)
+                failed += 1
+                ok = False
+        if record_progress:
+            runs[path].done(offset, body, ok)
+
+    if record_progress:
+        for run in runs.values():
+            run.finish()
+    return handled, failed, time.monotonic() - started
+
+
+if __name__ == '__main__':
+    arg_parser = ArgumentParser(
+        usage='Usage: python ' + __file__ + ' <journal dir> [--all] [--speed <n>] [--live] [--profile <file>]'
+    )
+    arg_parser.add_argument('directory', help='WEBHOOK_JOURNAL_DIR of the app')
+    arg_parser.add_argument('--all', action='store_true', help='ignore checkpoints and replay every retained record')
+    arg_parser.add_argument('--speed', type=float, default=0.0,
+                            help='1 for original timing, 10 for 10x faster, 0 (default) for no delay')
+    arg_parser.add_argument('--live', action='store_true', help='call the real LINE API instead of the mock')
+    arg_parser.add_argument('--profile', default=None, help='write cProfile stats to this file')
+    options = arg_parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    if not options.live:
+        urllib3.PoolManager.urlopen = mock_urlopen
+
+    profiler = cProfile.Profile() if options.profile else None
+    if profiler is not None:
+        profiler.enable()
+    handled, failed, elapsed = replay(options.directory, options.all, options.speed,
+                                      record_progress=options.live)
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(options.profile)
+
+    print('Replayed %d bodies (%d failed) in %.2fs' % (handled + failed, failed, elapsed))
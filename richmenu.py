@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+
+#  Licensed under the Apache License, Version 2.0 (the "License"); you may
+#  not use this file except in compliance with the License. You may obtain
+#  a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#  License for the specific language governing permissions and limitations
+#  under the License.
+
+"""Batched per-user rich menu links.
+
+assign() only records the wanted rich menu of a user. A background thread
+collects them for `flush_interval` seconds (or until BULK_LIMIT users are
+waiting), groups them by rich menu and calls the bulk link/unlink
+endpoints in chunks of BULK_LIMIT. The rich menu last linked to each user
+is cached, so assigning the same menu again costs nothing. With a shared
+`store` (see kvstore.py) the links are also recorded there, and users whose
+menu another node already linked are skipped with one batched lookup.
+"""
+
+import logging
+import os
+import threading
+from collections import namedtuple
+
+from linebot.v3.messaging import (
+    ApiClient,
+    MessagingApi,
+    ApiException,
+    RichMenuBulkLinkRequest,
+    RichMenuBulkUnlinkRequest
+)
+
+
+BULK_LIMIT = 500
+STORE_PREFIX = 'richmenu:'
+
+logger = logging.getLogger(__name__)
+
+Progress = namedtuple('Progress', ['pending', 'linked', 'unlinked', 'skipped', 'failed'])
+
+_UNKNOWN = object()
+
+
+class RichMenuAssigner(object):
+
+    def __init__(self, configuration, flush_interval=1.0, max_cache=1000000, store=None):
+        self.configuration = configuration
+        self.store = store
+        self.flush_interval = flush_interval
+        self.max_cache = max_cache
+        self._cache = {}
+        self._pending = {}
+        self._cond = threading.Condition()
+        self._linked = self._unlinked = self._skipped = self._failed = 0
+        self._pid = None
+
+    def assign(self, user_id, rich_menu_id):
+        """Link rich_menu_id to user_id, or unlink the user's menu if None."""
+        with self._cond:
+            if user_id not in self._pending and self._cache.get(user_id, _UNKNOWN) == rich_menu_id:
+                self._skipped += 1
+                return
+            self._pending[user_id] = rich_menu_id
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                threading.Thread(target=self._run, name='richmenu-assigner', daemon=True).start()
+            self._cond.notify()
+
+    def unassign(self, user_id):
+        self.assign(user_id, None)
+
+    def forget(self, user_id):
+        with self._cond:
+            self._cache.pop(user_id, None)
+        if self.store is not None:
+            try:
+                self.store.delete(STORE_PREFIX + user_id)
+            except Exception:
+                logger.exception("Failed to forget rich menu link in the store")
+
+    def progress(self):
+        with self._cond:
+            return Progress(len(self._pending), self._linked, self._unlinked, self._skipped, self._failed)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending)
+                self._cond.wait_for(lambda: len(self._pending) >= BULK_LIMIT, timeout=self.flush_interval)
+                pending, self._pending = self._pending, {}
+
+            pending = self._unlinked_in_store(pending)
+            by_menu = {}
+            for user_id, rich_menu_id in pending.items():
+                by_menu.setdefault(rich_menu_id, []).append(user_id)
+            with ApiClient(self.configuration) as api_client:
+                line_bot_api = MessagingApi(api_client)
+                for rich_menu_id, user_ids in by_menu.items():
+                    for i in range(0, len(user_ids), BULK_LIMIT):
+                        self._send(line_bot_api, rich_menu_id, user_ids[i:i + BULK_LIMIT])
+            logger.info("Rich menu links: %s", self.progress())
+
+    def _unlinked_in_store(self, pending):
+        if self.store is None:
+            return pending
+        try:
+            stored = self.store.get_many([STORE_PREFIX + user_id for user_id in pending])
+        except Exception:
+            logger.exception("Failed to read rich menu links from the store")
+            return pending
+
+        result = {}
+        with self._cond:
+            for user_id, rich_menu_id in pending.items():
+                if stored.get(STORE_PREFIX + user_id) == (rich_menu_id or '').encode('utf-8'):
+                    self._skipped += 1
+                    self._cache.pop(user_id, None)
+                    self._cache[user_id] = rich_menu_id
+                else:
+                    result[user_id] = rich_menu_id
+        return result
+
+    def _send(self, line_bot_api, rich_menu_id, user_ids):
+        try:
+            if rich_menu_id is None:
+                line_bot_api.unlink_rich_menu_id_from_users(RichMenuBulkUnlinkRequest(user_ids=user_ids))
+            else:
+                line_bot_api.link_rich_menu_id_to_users(
+                    RichMenuBulkLinkRequest(rich_menu_id=rich_menu_id, user_ids=user_ids))
+        except Exception as e:
+            # keep the thread alive on network errors as well as API errors
+            logger.warning("Failed to update rich menu of %d users: %s", len(user_ids),
+                           e.body if isinstance(e, ApiException) else e)
+            with self._cond:
+                self._failed += len(user_ids)
+                for user_id in user_ids:
+                    self._cache.pop(user_id, None)
+            return
+
+        with self._cond:
+            if rich_menu_id is None:
+                self._unlinked += len(user_ids)
+            else:
+                self._linked += len(user_ids)
+            for user_id in user_ids:
+                self._cache.pop(user_id, None)
+                self._cache[user_id] = rich_menu_id
+            while len(self._cache) > self.max_cache:
+                del self._cache[next(iter(self._cache))]
+
+        if self.store is not None:
+            value = (rich_menu_id or '').encode('utf-8')
+            try:
+                self.store.set_many({STORE_PREFIX + user_id: value for user_id in user_ids})
+            except Exception:
+                logger.exception("Failed to record rich menu links in the store")
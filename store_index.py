@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+
+#  Licensed under the Apache License, Version 2.0 (the "License"); you may
+#  not use this file except in compliance with the License. You may obtain
+#  a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#  License for the specific language governing permissions and limitations
+#  under the License.
+
+"""Nearest-store lookup backed by an implicit k-d tree.
+
+The tree is stored as a flat binary file so that it can be memory-mapped
+by every worker process and shared through the page cache:
+
+    header   '<8sQ'  magic, number of stores
+    coords   5 * n float64  x, y, z (unit sphere), latitude, longitude
+    offsets  (n + 1) uint64  offsets of each record in the text blob
+    text     utf-8  'name\\x1faddress' for each store
+
+Points are laid out in k-d tree order: the node of the range [lo, hi) is
+at (lo + hi) // 2 and splits on axis depth % 3.
+
+Build an index file from a CSV with name,address,latitude,longitude columns:
+
+    python store_index.py stores.csv stores.idx
+"""
+
+import csv
+import heapq
+import math
+import mmap
+import struct
+import sys
+from collections import namedtuple
+from operator import itemgetter
+
+
+MAGIC = b'STIDX001'
+HEADER = struct.Struct('<8sQ')
+EARTH_RADIUS_M = 6371008.8
+FIELD_SEPARATOR = '\x1f'
+
+Store = namedtuple('Store', ['name', 'address', 'latitude', 'longitude', 'distance'])
+
+
+def _to_xyz(latitude, longitude):
+    lat = math.radians(latitude)
+    lon = math.radians(longitude)
+    cos_lat = math.cos(lat)
+    return cos_lat * math.cos(lon), cos_lat * math.sin(lon), math.sin(lat)
+
+
+def _build_tree(points, lo, hi, axis):
+    while hi - lo > 1:
+        mid = (lo + hi) >> 1
+        points[lo:hi] = sorted(points[lo:hi], key=itemgetter(axis))
+        next_axis = axis + 1 if axis < 2 else 0
+        _build_tree(points, lo, mid, next_axis)
+        lo, axis = mid + 1, next_axis
+
+
+def read_csv(path):
+    with open(path, newline='', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            yield (row['name'], row.get('address') or '',
+                   float(row['latitude']), float(row['longitude']))
+
+
+def build(stores):
+    points = []
+    for name, address, latitude, longitude in stores:
+        x, y, z = _to_xyz(latitude, longitude)
+        points.append((x, y, z, latitude, longitude, name, address))
+    _build_tree(points, 0, len(points), 0)
+
+    n = len(points)
+    texts = [(p[5] + FIELD_SEPARATOR + p[6]).encode('utf-8') for p in points]
+    offsets = [0]
+    for text in texts:
+        offsets.append(offsets[-1] + len(text))
+
+    buf = bytearray(HEADER.pack(MAGIC, n))
+    buf += struct.pack('<%dd' % (5 * n), *[v for p in points for v in p[:5]])
+    buf += struct.pack('<%dQ' % (n + 1), *offsets)
+    buf += b''.join(texts)
+    return bytes(buf)
+
+
+class StoreIndex(object):
+
+    def __init__(self, data):
+        magic, n = HEADER.unpack_from(data, 0)
+        if magic != MAGIC:
+            raise ValueError('Not a store index file')
+        self._data = data
+        view = memoryview(data)
+        coords_end = HEADER.size + 40 * n
+        offsets_end = coords_end + 8 * (n + 1)
+        self._size = n
+        self._coords = view[HEADER.size:coords_end].cast('d')
+        self._offsets = view[coords_end:offsets_end].cast('Q')
+        self._text = view[offsets_end:]
+
+    def __len__(self):
+        return self._size
+
+    @classmethod
+    def from_csv(cls, path):
+        return cls(build(read_csv(path)))
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            return cls(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def _store(self, i, d2):
+        c = self._coords
+        text = bytes(self._text[self._offsets[i]:self._offsets[i + 1]]).decode('utf-8')
+        name, _, address = text.partition(FIELD_SEPARATOR)
+        distance = 2 * EARTH_RADIUS_M * math.asin(min(1.0, math.sqrt(d2) / 2))
+        return Store(name, address, c[i * 5 + 3], c[i * 5 + 4], distance)
+
+    def nearest(self, latitude, longitude, k=1):
+        q = _to_xyz(latitude, longitude)
+        qx, qy, qz = q
+        c = self._coords
+        heap = []  # max-heap of (-squared chord distance, position)
+        stack = [(0, self._size, 0, 0.0)]
+        while stack:
+            lo, hi, axis, bound = stack.pop()
+            if lo >= hi or (len(heap) == k and bound >= -heap[0][0]):
+                continue
+            mid = (lo + hi) >> 1
+            base = mid * 5
+            dx = qx - c[base]
+            dy = qy - c[base + 1]
+            dz = qz - c[base + 2]
+            d2 = dx * dx + dy * dy + dz * dz
+            if len(heap) < k:
+                heapq.heappush(heap, (-d2, mid))
+            elif d2 < -heap[0][0]:
+                heapq.heapreplace(heap, (-d2, mid))
+
+            diff = q[axis] - c[base + axis]
+            next_axis = axis + 1 if axis < 2 else 0
+            if diff < 0:
+                stack.append((mid + 1, hi, next_axis, diff * diff))
+                stack.append((lo, mid, next_axis, 0.0))
+            else:
+                stack.append((lo, mid, next_axis, diff * diff))
+                stack.append((mid + 1, hi, next_axis, 0.0))
+
+        return [self._store(i, -neg_d2) for neg_d2, i in sorted(heap, reverse=True)]
+
+
+def load_store_index(path):
+    if path.lower().endswith('.csv'):
+        return StoreIndex.from_csv(path)
+    return StoreIndex.load(path)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print('Usage: python ' + __file__ + ' <stores.csv> <stores.idx>')
+        sys.exit(1)
+    data = build(read_csv(sys.argv[1]))
+    with open(sys.argv[2], 'wb') as f:
+        f.write(data)
+    print('Wrote %d stores to %s' % (HEADER.unpack_from(data, 0)[1], sys.argv[2]))
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+
+#  Licensed under the Apache License, Version 2.0 (the "License"); you may
+#  not use this file except in compliance with the License. You may obtain
+#  a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#  License for the specific language governing permissions and limitations
+#  under the License.
+
+import random
+
+import pytest
+from linebot.v3.audience import ApiException
+
+import audience
+from audience import UserIdSet, unique_chunks
+
+
+def _user_ids(n, seed=1):
+    rng = random.Random(seed)
+    return ['U%032x' % rng.getrandbits(128) for _ in range(n)]
+
+
+def test_user_id_set_deduplicates_and_grows():
+    user_ids = _user_ids(1000)
+    seen = UserIdSet(capacity=4)
+    assert all(seen.add(user_id) for user_id in user_ids)
+    assert not any(seen.add(user_id) for user_id in user_ids)
+    assert len(seen) == len(user_ids)
+
+
+def test_user_id_set_all_zero_id():
+    seen = UserIdSet()
+    assert seen.add('U' + '0' * 32)
+    assert not seen.add('U' + '0' * 32)
+    assert len(seen) == 1
+
+
+def test_unique_chunks():
+    user_ids = _user_ids(25)
+    chunks = list(unique_chunks(user_ids + user_ids[:10] + user_ids, size=10))
+    assert [len(chunk) for chunk in chunks] == [10, 10, 5]
+    assert sum(chunks, []) == user_ids
+
+
+@pytest.mark.parametrize('error, calls', [
+    (ApiException(status=400), 1),
+    (ApiException(status=429), audience.MAX_RETRIES),
+    (ApiException(status=503), audience.MAX_RETRIES),
+    (ConnectionResetError(), audience.MAX_RETRIES),
+])
+def test_with_retries(monkeypatch, error, calls):
+    monkeypatch.setattr(audience.time, 'sleep', lambda seconds: None)
+    attempts = []
+
+    def request():
+        attempts.append(1)
+        raise error
+
+    with pytest.raises(type(error)):
+        audience._with_retries(request)
+    assert len(attempts) == calls
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+#  Licensed under the Apache License, Version 2.0 (the "License"); you may
+#  not use this file except in compliance with the License. You may obtain
+#  a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#  License for the specific language governing permissions and limitations
+#  under the License.
+
+import os
+
+from journal import (
+    RECORD_HEADER,
+    Journal,
+    is_running,
+    iter_records,
+    journal_dirs,
+    read_checkpoint,
+    read_failed
+)
+
+
+def _records(path, start=0):
+    return [(offset, body) for offset, _, body in iter_records(path, start)]
+
+
+def _segment_bases(path):
+    return sorted(int(name.split('.')[0]) for name in os.listdir(path) if name.endswith('.seg'))
+
+
+def test_append_and_read_back(tmp_path):
+    journal = Journal(str(tmp_path))
+    bodies = [b'{"events": []}', b'', b'x' * 1000]
+    offsets = [journal.append(body) for body in bodies]
+    assert offsets == [0, RECORD_HEADER.size + len(bodies[0]), 2 * RECORD_HEADER.size + len(bodies[0])]
+    assert journal_dirs(str(tmp_path)) == [journal.path]
+    assert _records(journal.path) == list(zip(offsets, bodies))
+    assert _records(journal.path, offsets[1]) == list(zip(offsets[1:], bodies[1:]))
+    # this process still writes it, but replay.py runs in another one
+    assert not is_running(journal.path)
+
+    for offset in offsets:
+        journal.commit(offset)
+    journal.close()
+    assert not os.path.exists(journal.path)
+
+
+def test_checkpoint_and_failed(tmp_path):
+    journal = Journal(str(tmp_path))
+    offsets = [journal.append(b'%d' % i) for i in range(3)]
+    journal.commit(offsets[0])
+    journal.fail(offsets[1])
+    journal.close()
+
+    # the pending record holds back the checkpoint, the failed one does not
+    assert read_checkpoint(journal.path) == offsets[2]
+    assert read_failed(journal.path) == {offsets[1]}
+
+
+def test_handled_segments_are_removed(tmp_path):
+    journal = Journal(str(tmp_path), segment_bytes=1)
+    offsets = [journal.append(b'%d' % i) for i in range(4)]
+    assert _segment_bases(journal.path) == offsets
+    journal.commit(offsets[0])
+    journal.fail(offsets[1])
+    journal.commit(offsets[2])
+    journal.close()
+
+    assert _segment_bases(journal.path) == [offsets[1], offsets[3]]
+    assert _records(journal.path) == [(offsets[1], b'1'), (offsets[3], b'3')]
+
+
+def test_torn_record_ends_the_segment(tmp_path):
+    journal = Journal(str(tmp_path))
+    offsets = [journal.append(b'first'), journal.append(b'second')]
+    journal.close()
+    segment_path = os.path.join(journal.path, '%020d.seg' % 0)
+
+    with open(segment_path, 'r+b') as f:
+        f.seek(offsets[1] + RECORD_HEADER.size)
+        f.write(b'S')  # crc mismatch
+    assert _records(journal.path) == [(0, b'first')]
+
+    with open(segment_path, 'r+b') as f:
+        f.truncate(offsets[1] + 3)  # partial header
+    assert _records(journal.path) == [(0, b'first')]
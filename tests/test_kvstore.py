@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+#  Licensed under the Apache License, Version 2.0 (the "License"); you may
+#  not use this file except in compliance with the License. You may obtain
+#  a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#  License for the specific language governing permissions and limitations
+#  under the License.
+
+import threading
+import time
+
+import pytest
+
+from kvstore import (
+    KVBackend,
+    MemoryBackend,
+    RedisBackend,
+    RespError,
+    RespServer,
+    SqliteBackend,
+    open_backend
+)
+
+
+@pytest.fixture(params=['memory', 'sqlite', 'redis'])
+def store(request, tmp_path):
+    if request.param == 'memory':
+        yield MemoryBackend()
+    elif request.param == 'sqlite':
+        yield SqliteBackend(str(tmp_path / 'kv.sqlite3'))
+    else:
+        server = RespServer(('127.0.0.1', 0))
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            yield RedisBackend(*server.server_address)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+def test_backend_is_abstract():
+    with pytest.raises(TypeError):
+        KVBackend()
+
+
+def test_get_set_delete(store):
+    assert store.get('a') is None
+    store.set_many({'a': b'1', 'b': b'2'})
+    assert store.get_many(['a', 'b', 'c']) == {'a': b'1', 'b': b'2'}
+    store.set('a', b'3')
+    assert store.get('a') == b'3'
+    store.delete_many(['a', 'c'])
+    assert store.get_many(['a', 'b']) == {'b': b'2'}
+    assert store.get_many([]) == {}
+
+
+def test_add_only_sets_missing_keys(store):
+    store.set('a', b'1')
+    assert store.add_many({'a': b'2', 'b': b'2'}) == {'a': False, 'b': True}
+    assert store.get_many(['a', 'b']) == {'a': b'1', 'b': b'2'}
+    assert store.add('b', b'3') is False
+
+
+def test_ttl(store):
+    store.set('short', b'1', ttl=0.05)
+    store.set('long', b'1', ttl=60)
+    store.set('forever', b'1')
+    assert store.add('claim', b'1', ttl=0.05)
+    time.sleep(0.1)
+    assert store.get_many(['short', 'long', 'forever']) == {'long': b'1', 'forever': b'1'}
+    # an expired key can be claimed again
+    assert store.add('claim', b'2', ttl=60)
+    assert store.get('claim') == b'2'
+
+
+def test_sets(store):
+    store.set_add('s', ['a', 'b'])
+    store.set_add('s', ['b', 'c'])
+    store.set_add('s', [])
+    assert store.set_members('s') == {'a', 'b', 'c'}
+    assert store.set_count('s') == 3
+    assert store.set_contains('s', 'a')
+    store.set_remove('s', ['a', 'x'])
+    assert not store.set_contains('s', 'a')
+    assert store.set_members('missing') == set()
+    assert store.set_count('missing') == 0
+    store.delete('s')
+    assert store.set_count('s') == 0
+
+
+def test_batch(store):
+    results = store.batch([
+        ('add', 'state', b'loading', 60),
+        ('add', 'state', b'other', 60),
+        ('get', 'state'),
+        ('set_add', 'members', ['a', 'b']),
+        ('set_remove', 'members', []),
+        ('set_count', 'members'),
+        ('set_contains', 'members', 'b'),
+        ('set_members', 'members'),
+        ('set', 'state', b'complete'),
+        ('get', 'state'),
+        ('delete', 'state'),
+        ('get', 'state'),
+    ])
+    assert results == [True, False, b'loading', None, None, 2, True, {'a', 'b'}, None, b'complete', None, None]
+    assert store.batch([]) == []
+    with pytest.raises(ValueError):
+        store.batch([('get_many', ['state'])])
+
+
+def test_sqlite_is_shared_between_instances(tmp_path):
+    path = str(tmp_path / 'nested' / 'kv.sqlite3')
+    SqliteBackend(path).set('a', b'1')
+    assert SqliteBackend(path).get('a') == b'1'
+
+
+def test_redis_pipeline_errors():
+    server = RespServer(('127.0.0.1', 0))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        backend = RedisBackend(*server.server_address)
+        assert backend.pipeline([('PING',), ('SET', 'a', b'1')]) == [b'PONG', b'OK']
+        with pytest.raises(RespError):
+            backend.pipeline([('GET', 'a'), ('NOSUCHCOMMAND',)])
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_open_backend(tmp_path):
+    assert isinstance(open_backend('memory://'), MemoryBackend)
+    assert isinstance(open_backend('sqlite:///' + str(tmp_path / 'kv.sqlite3')), SqliteBackend)
+    backend = open_backend('redis://:secret@example.com:6380/2')
+    assert (backend.host, backend.port, backend.db, backend.password) == ('example.com', 6380, 2, 'secret')
+    with pytest.raises(ValueError):
+        open_backend('memcached://localhost')
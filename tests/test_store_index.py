@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+#  Licensed under the Apache License, Version 2.0 (the "License"); you may
+#  not use this file except in compliance with the License. You may obtain
+#  a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#  License for the specific language governing permissions and limitations
+#  under the License.
+
+import math
+import random
+
+import pytest
+
+from store_index import EARTH_RADIUS_M, StoreIndex, build
+
+
+def _haversine(latitude1, longitude1, latitude2, longitude2):
+    phi1, phi2 = math.radians(latitude1), math.radians(latitude2)
+    a = (math.sin((phi2 - phi1) / 2) ** 2
+         + math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(longitude2 - longitude1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(a))
+
+
+@pytest.fixture
+def stores():
+    rng = random.Random(1)
+    return [('store %d' % i, 'address %d' % i, rng.uniform(21.9, 25.3), rng.uniform(120.0, 122.0))
+            for i in range(500)]
+
+
+def test_nearest_matches_brute_force(stores):
+    index = StoreIndex(build(stores))
+    assert len(index) == len(stores)
+    rng = random.Random(2)
+    for _ in range(50):
+        latitude, longitude = rng.uniform(21.5, 25.5), rng.uniform(119.5, 122.5)
+        expected = sorted(stores, key=lambda s: _haversine(latitude, longitude, s[2], s[3]))[:3]
+        found = index.nearest(latitude, longitude, k=3)
+        assert [s.name for s in found] == [s[0] for s in expected]
+        for store, (_, address, store_latitude, store_longitude) in zip(found, expected):
+            assert store.address == address
+            assert (store.latitude, store.longitude) == (store_latitude, store_longitude)
+            assert store.distance == pytest.approx(_haversine(latitude, longitude, store_latitude, store_longitude))
+
+
+def test_load_from_file(tmp_path, stores):
+    path = tmp_path / 'stores.idx'
+    path.write_bytes(build(stores))
+    index = StoreIndex.load(str(path))
+    name, address, latitude, longitude = stores[123]
+    assert index.nearest(latitude, longitude)[0][:4] == (name, address, latitude, longitude)
+
+
+def test_small_and_empty_indexes():
+    assert StoreIndex(build([])).nearest(25.0, 121.5) == []
+    index = StoreIndex(build([('only', '', 25.0, 121.5)]))
+    assert [s.name for s in index.nearest(0.0, 0.0, k=5)] == ['only']
+
+
+def test_rejects_other_files():
+    with pytest.raises(ValueError):
+        StoreIndex(b'\0' * 64)